@@ -161,6 +161,8 @@ class EmoLossBase(torch.nn.Module):
         self.au_loss = au_loss or F.l1_loss
         self.input_emotion = None
         self.output_emotion = None
+        # key of the expression prediction in the emotion dicts ('expression' or 'expr_classification'), see compute_loss
+        self.expression_key = None
         self.trainable = trainable
 
     @property
@@ -180,14 +182,17 @@ class EmoLossBase(torch.nn.Module):
     def _forward_output(self, images):
         return self(images)
 
-    def compute_loss(self, input_images, output_images, batch_size=None, ring_size=None):
+    def compute_loss(self, input_images, output_images, batch_size=None, ring_size=None, input_emotion=None):
         # input_emotion = None
         # self.output_emotion = None
 
-        input_emotion = self._forward_input(input_images)
+        # the emotion of the input images may be passed in if it has already been computed (it never requires gradient)
+        if input_emotion is None:
+            input_emotion = self._forward_input(input_images)
         output_emotion = self._forward_output(output_images)
         self.input_emotion = input_emotion
         self.output_emotion = output_emotion
+        self.expression_key = 'expression' if 'expression' in input_emotion.keys() else 'expr_classification'
 
         if 'emo_feat' in input_emotion.keys():
             input_emofeat = input_emotion['emo_feat']
@@ -22,6 +22,13 @@ https://github.com/YadiraF/DECA/
 
 
 import os, sys
+import math
+import time
+import queue
+import threading
+import atexit
+import psutil
+from functools import lru_cache
 import torch
 import torchvision
 import torch.nn.functional as F
@@ -56,11 +63,236 @@ from omegaconf import OmegaConf, open_dict
 import pytorch_lightning.plugins.environments.lightning_environment as le
 
 
+def _flatten_ring(t, item_ndim):
+    """
+    Flattens the batch and ring dimensions ([B, K, ...] ==> [BxK, ...]) of a tensor whose items have item_ndim dimensions.
+    Batches that are already flat are returned as they are (no reshape). None is passed through.
+    """
+    if t is None or t.ndim == item_ndim + 1:
+        return t
+    return t.flatten(0, -item_ndim - 1)
+
+
+def _duplicate(t):
+    """
+    Duplicates the tensor along the batch dimension (same as torch.cat([t, t], dim=0) but with a single copy kernel).
+    """
+    if t is None:
+        return None
+    return t.repeat((2,) + (1,) * (t.ndim - 1))
+
+
+@lru_cache(maxsize=8)
+def _ring_offsets(batch_size, ring_size, device):
+    """
+    Index offsets of the rings in a flattened [batch_size x ring_size] batch. The shapes are fixed during training,
+    so the offsets are only created once per configuration.
+    """
+    return torch.arange(batch_size, device=device).unsqueeze(1) * ring_size
+
+
+def _ring_permutation(batch_size, ring_size, device):
+    """
+    Creates a random permutation of a flattened [batch_size x ring_size] batch that only shuffles within each ring.
+    The permutation is generated directly on the device (no numpy round-trip and host-to-device copy).
+    """
+    permutation = torch.argsort(torch.rand(batch_size, ring_size, device=device), dim=1)
+    return (permutation + _ring_offsets(batch_size, ring_size, device)).reshape(-1)
+
+
+@torch.jit.script
+def _composite_background(images: torch.Tensor, masks: torch.Tensor, rendered: torch.Tensor) -> torch.Tensor:
+    """
+    Pastes the rendered image over the input image using the mask. Scripted so that the pointwise chain
+    gets fused into a single kernel by the JIT fuser.
+    """
+    return (1. - masks) * images + masks * rendered
+
+
+@torch.jit.script
+def _mask_union(masks: torch.Tensor, mask_face_eye: torch.Tensor, alpha_images: torch.Tensor) -> torch.Tensor:
+    """
+    Union of the GT mask and the rendered face mask. Scripted so that the multiply and max get fused into one kernel.
+    """
+    return torch.max(masks, mask_face_eye * alpha_images)
+
+
+@torch.jit.script
+def _masked_l1(prediction: torch.Tensor, target: torch.Tensor, masks: torch.Tensor) -> torch.Tensor:
+    """
+    Masked L1 difference (the photometric loss). Scripted so that the pointwise chain gets fused into a single kernel.
+    """
+    return (masks * (prediction - target).abs()).mean()
+
+
+@torch.jit.script
+def _displace_vertices(uv_z: torch.Tensor, uv_coarse_vertices: torch.Tensor, uv_coarse_normals: torch.Tensor,
+                       uv_face_eye_mask: torch.Tensor, fixed_uv_dis: torch.Tensor) -> torch.Tensor:
+    """
+    Detail vertices in UV space = coarse vertices + (masked predicted displacement + fixed displacement) * normals.
+    Scripted so that the pointwise chain gets fused into a single kernel by the JIT fuser.
+    """
+    return uv_coarse_vertices + (uv_z * uv_face_eye_mask + fixed_uv_dis) * uv_coarse_normals
+
+
+def _autocast_dtype_kwargs():
+    """
+    The dtype of the active (GPU) autocast as keyword arguments of torch.cuda.amp.autocast. Torch versions before 1.10
+    only autocast to float16 and do not have the argument.
+    """
+    if hasattr(torch, 'get_autocast_gpu_dtype'):
+        return {'dtype': torch.get_autocast_gpu_dtype()}
+    return {}
+
+
+def _autocast_state():
+    """
+    The state of the (GPU) autocast, (enabled, dtype), see _compute_emotion_loss.
+    """
+    if not torch.is_autocast_enabled():
+        return False, None
+    return True, _autocast_dtype_kwargs().get('dtype', torch.float16)
+
+
+def _scalars_to_floats(tensor_dict):
+    """
+    Converts a dict of scalar tensors (losses and metrics) to python floats with a single device-to-host copy, instead
+    of one synchronizing .item() call per entry.
+    """
+    if len(tensor_dict) == 0:
+        return {}
+    values = torch.stack([value.detach().reshape(()).float() for value in tensor_dict.values()]).cpu().tolist()
+    return dict(zip(tensor_dict.keys(), values))
+
+
+def _tensors_to_host(tensors):
+    """
+    Copies a list of float tensors (of any shapes) to the host with a single device-to-host transfer.
+    """
+    flat = torch.cat([t.detach().reshape(-1).float() for t in tensors]).cpu()
+    return [part.view(t.shape) for part, t in zip(flat.split([t.numel() for t in tensors]), tensors)]
+
+
+_PROCESS = None
+
+
+def _current_process():
+    """
+    The psutil handle of the current process, shared by all modules (recreated if the process was forked).
+    """
+    global _PROCESS
+    if _PROCESS is None or _PROCESS.pid != os.getpid():
+        _PROCESS = psutil.Process(os.getpid())
+    return _PROCESS
+
+
+_WRITE_QUEUE = None
+_WRITER_PID = None
+# exceptions of the failed asynchronous writes, re-raised by _raise_write_errors
+_WRITE_ERRORS = []
+
+
+def _write_worker(write_queue):
+    while True:
+        item = write_queue.get()
+        try:
+            if item is None:
+                return
+            write_fn, args, kwargs = item
+            write_fn(*args, **kwargs)
+        except Exception as e:
+            _WRITE_ERRORS.append(e)
+        finally:
+            write_queue.task_done()
+
+
+def _raise_write_errors():
+    if len(_WRITE_ERRORS) > 0:
+        errors = _WRITE_ERRORS[:]
+        del _WRITE_ERRORS[:]
+        raise RuntimeError(f"{len(errors)} asynchronous write(s) failed, the first error: {errors[0]!r}") from errors[0]
+
+
+def _write_async(write_fn, *args, **kwargs):
+    """
+    Queues a disk write (cv2.imwrite, util.write_obj, ...) to be executed by a background thread, so that the training
+    loop does not wait for the encoding and the disk. The writer is kept at the module level (not in the nn.Module,
+    which has to stay picklable) and is (re)started lazily, also after a fork. The queue is bounded, if the disk
+    cannot keep up, the caller blocks instead of piling up images in memory.
+    The numpy arguments are copied, so the caller is free to modify them. Failures of previous writes are raised here
+    (and by flush_async_writes).
+    """
+    global _WRITE_QUEUE, _WRITER_PID
+    _raise_write_errors()
+    if _WRITE_QUEUE is None or _WRITER_PID != os.getpid():
+        _WRITE_QUEUE = queue.Queue(maxsize=32)
+        _WRITER_PID = os.getpid()
+        del _WRITE_ERRORS[:]
+        threading.Thread(target=_write_worker, args=(_WRITE_QUEUE,), daemon=True).start()
+    args = tuple(a.copy() if isinstance(a, np.ndarray) else a for a in args)
+    kwargs = {k: v.copy() if isinstance(v, np.ndarray) else v for k, v in kwargs.items()}
+    _WRITE_QUEUE.put((write_fn, args, kwargs))
+
+
+def _write_now(write_fn, *args, **kwargs):
+    """
+    Synchronous counterpart of _write_async.
+    """
+    return write_fn(*args, **kwargs)
+
+
+def flush_async_writes():
+    """
+    Blocks until all the queued asynchronous writes are on disk. Raises if any of them failed.
+    """
+    if _WRITE_QUEUE is not None and _WRITER_PID == os.getpid():
+        _WRITE_QUEUE.join()
+        _raise_write_errors()
+
+
+# the writer thread is a daemon, the pending writes are finished before the interpreter exits
+atexit.register(flush_async_writes)
+
+
+def _visualizations_to_np(visdict):
+    """
+    Converts a dict of image tensors to numpy images. Tensors of the same shape, type and device are stacked and moved
+    to the host together (one copy per group instead of one per entry). Floating point images are clamped to [0, 1]
+    before the copy.
+    """
+    groups = {}
+    for key, value in visdict.items():
+        value = value.detach()
+        groups.setdefault((tuple(value.shape), value.dtype, value.device), []).append((key, value))
+    images = {}
+    for group in groups.values():
+        stacked = torch.stack([value for _, value in group])
+        if stacked.is_floating_point():
+            stacked = stacked.clamp_(0, 1)
+        stacked = stacked.cpu()
+        for i, (key, _) in enumerate(group):
+            images[key] = _torch_image2np(stacked[i])
+    return images
+
+
 class DecaMode(Enum):
     COARSE = 1 # when switched on, only coarse part of DECA-based networks is used
     DETAIL = 2 # when switched on, only coarse and detail part of DECA-based networks is used 
 
 
+class SegmentationType(Enum):
+    GT = 1 # external segmentation (predicted by face parsing or similar)
+    REND = 2 # mask rendered as a silhouette of the face mesh
+    INTERSECTION = 3 # intersection of the two above
+    UNION = 4 # union of the two above
+
+
+class BackgroundMode(Enum):
+    INPUT = 1 # background is taken from the input image
+    BLACK = 2 # background is black
+    NONE = 3 # background is not handled
+
+
 class DecaModule(LightningModule):
     """
     DecaModule is a PL module that implements DECA-inspired face reconstruction networks. 
@@ -116,12 +348,30 @@ class DecaModule(LightningModule):
         # instantiate the network
         self.deca = deca_class(config=model_params)
 
+        # contiguous batch-expanded copies of constant tensors (such as the UV face mask), see _expand_to_batch
+        self._batch_expansion_cache = {}
+        # reusable input buffer of the detail generator, see _concat_detail_conditioning
+        self._detail_conditioning_buffer = None
+        # zero target domain of the image translator, see _zero_target_domain
+        self.register_buffer('_zero_domain', torch.zeros(0, dtype=torch.int64), persistent=False)
+        # emotion of the last reference images passed to the emotion loss, see _compute_emotion_loss
+        self._reference_emotion = None
+        # side CUDA stream of the VGG loss, see _vgg_loss_stream
+        self._vgg_stream = None
+        # (id of the logger, whether it is a WandbLogger), see _wandb_logging
+        self._wandb_logging_cache = None
+
         self.mode = DecaMode[str(model_params.mode).upper()]
         self.stage_name = stage_name
         if self.stage_name is None:
             self.stage_name = ""
         if len(self.stage_name) > 0:
             self.stage_name += "_"
+
+        # resolve the segmentation and background config once (instead of in every decode call)
+        self._init_masking_config()
+        # same for the coarse encoding pass (with or without gradient)
+        self._init_flame_encoding()
         
         # initialize the emotion perceptual loss (used for EMOCA supervision)
         self.emonet_loss = None
@@ -172,6 +422,10 @@ class DecaModule(LightningModule):
                                                normalize_features=normalize_features,
                                                emo_feat_loss=emo_feat_loss)
 
+            if 'channels_last' in self.deca.config.keys() and self.deca.config.channels_last:
+                # the emotion network consumes the channels last rendered images, see decode
+                self.emonet_loss.to(memory_format=torch.channels_last)
+
             if old_emonet_loss is not None and type(old_emonet_loss) != self.emonet_loss:
                 print(f"The old emonet loss {old_emonet_loss.__class__.__name__} is replaced during reconfiguration by "
                       f"new emotion loss {self.emonet_loss.__class__.__name__}")
@@ -179,6 +433,34 @@ class DecaModule(LightningModule):
         else:
             self.emonet_loss = None
 
+    def _init_masking_config(self):
+        """
+        Resolves the 'useSeg' and 'background_from_input' configs into the segmentation type and background mode used
+        by decode. Needs to be called again if these configs are changed after construction.
+        """
+        if isinstance(self.deca.config.useSeg, bool):
+            if self.deca.config.useSeg:
+                segmentation_type = 'gt'
+            else:
+                segmentation_type = 'rend'
+        elif isinstance(self.deca.config.useSeg, str):
+            segmentation_type = self.deca.config.useSeg
+        else:
+            raise RuntimeError(f"Invalid 'useSeg' type: '{type(self.deca.config.useSeg)}'")
+
+        if segmentation_type not in ["gt", "rend", "intersection", "union"]:
+            raise ValueError(f"Invalid segmentation type for masking '{segmentation_type}'")
+        self._segmentation_type = SegmentationType[segmentation_type.upper()]
+
+        if self.deca.config.background_from_input in [True, "input"]:
+            self._background_mode = BackgroundMode.INPUT
+        elif self.deca.config.background_from_input in [False, "black"]:
+            self._background_mode = BackgroundMode.BLACK
+        elif self.deca.config.background_from_input in ["none"]:
+            self._background_mode = BackgroundMode.NONE
+        else:
+            raise ValueError(f"Invalid type of background modification {self.deca.config.background_from_input}")
+
     def _init_au_loss(self):
         """
         Initialize the au perceptual loss (not currently used in EMOCA)
@@ -235,6 +517,7 @@ class DecaModule(LightningModule):
         else:
             self.deca._reconfigure(model_params)
 
+        self._init_masking_config()
         self._init_emotion_loss()
         self._init_au_loss()
 
@@ -244,6 +527,7 @@ class DecaModule(LightningModule):
         if len(self.stage_name) > 0:
             self.stage_name += "_"
         self.mode = DecaMode[str(model_params.mode).upper()]
+        self._init_flame_encoding()
         self.train(mode=train)
         print(f"EMOCA MODE RECONFIGURED TO: {self.mode}")
 
@@ -298,21 +582,36 @@ class DecaModule(LightningModule):
         return self
 
     def forward(self, batch):
-        values = self.encode(batch, training=False)
-        values = self.decode(values, training=False)
+        # forward is only used for inference, so no autograd bookkeeping is needed
+        with torch.inference_mode():
+            values = self.encode(batch, training=False)
+            values = self.decode(values, training=False)
         return values
 
-    def _encode_flame(self, images):
+    def _init_flame_encoding(self):
+        """
+        Selects the coarse encoding pass for the current mode once (instead of in every _encode_flame call).
+        Needs to be called again if the mode or the 'train_coarse' config are changed after construction.
+        """
         if self.mode == DecaMode.COARSE or \
                 (self.mode == DecaMode.DETAIL and self.deca.config.train_coarse):
             # forward pass with gradients (for coarse stage (used), or detail stage with coarse training (not used))
-            parameters = self.deca._encode_flame(images)
+            self._encode_flame_impl = self._encode_flame_with_grad
         elif self.mode == DecaMode.DETAIL:
             # in detail stage, the coarse forward pass does not need gradients
-            with torch.no_grad():
-                parameters = self.deca._encode_flame(images)
+            self._encode_flame_impl = self._encode_flame_without_grad
         else:
             raise ValueError(f"Invalid EMOCA Mode {self.mode}")
+
+    def _encode_flame_with_grad(self, images):
+        return self.deca._encode_flame(images)
+
+    def _encode_flame_without_grad(self, images):
+        with torch.no_grad():
+            return self.deca._encode_flame(images)
+
+    def _encode_flame(self, images):
+        parameters = self._encode_flame_impl(images)
         code_list = self.deca.decompose_code(parameters)
         shapecode, texcode, expcode, posecode, cam, lightcode = code_list
         return shapecode, texcode, expcode, posecode, cam, lightcode
@@ -324,13 +623,12 @@ class DecaModule(LightningModule):
         """
         Deprecated. Expression ring exchange is not used in EMOCA (nor DECA).
         """
-        new_order = np.array([np.random.permutation(K) + i * K for i in range(original_batch_size)])
-        new_order = new_order.flatten()
+        new_order = _ring_permutation(original_batch_size, K, expcode.device)
         expcode_new = expcode[new_order]
         ## append new shape code data
         expcode = torch.cat([expcode, expcode_new], dim=0)
-        texcode = torch.cat([texcode, texcode], dim=0)
-        shapecode = torch.cat([shapecode, shapecode], dim=0)
+        texcode = _duplicate(texcode)
+        shapecode = _duplicate(shapecode)
 
         globpose = posecode[..., :3]
         jawpose = posecode[..., 3:]
@@ -339,13 +637,13 @@ class DecaModule(LightningModule):
             jawpose_new = jawpose[new_order]
             jawpose = torch.cat([jawpose, jawpose_new], dim=0)
         else:
-            jawpose = torch.cat([jawpose, jawpose], dim=0)
+            jawpose = _duplicate(jawpose)
 
         if self.deca.config.expression_constrain_use_global_pose:
             globpose_new = globpose[new_order]
             globpose = torch.cat([globpose, globpose_new], dim=0)
         else:
-            globpose = torch.cat([globpose, globpose], dim=0)
+            globpose = _duplicate(globpose)
 
         if self.deca.config.expression_constrain_use_jaw_pose or self.deca.config.expression_constrain_use_global_pose:
             posecode = torch.cat([globpose, jawpose], dim=-1)
@@ -353,15 +651,14 @@ class DecaModule(LightningModule):
         else:
             # posecode_new = posecode
             # posecode_new = posecode
-            posecode = torch.cat([posecode, posecode], dim=0)
+            posecode = _duplicate(posecode)
 
-        cam = torch.cat([cam, cam], dim=0)
-        lightcode = torch.cat([lightcode, lightcode], dim=0)
+        cam = _duplicate(cam)
+        lightcode = _duplicate(lightcode)
         ## append gt
-        images = torch.cat([images, images],
-                           dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
-        lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-        masks = torch.cat([masks, masks], dim=0)
+        images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+        lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+        masks = _duplicate(masks)
 
 
         # NOTE:
@@ -386,7 +683,7 @@ class DecaModule(LightningModule):
 
         if detailcode is not None:
             #TODO: to exchange or not to exchange, that is the question, the answer is probably NO
-            detailcode = torch.cat([detailcode, detailcode], dim=0)
+            detailcode = _duplicate(detailcode)
             # detailcode = torch.cat([detailcode, detailcode[new_order]], dim=0)
         if detailemocode is not None:
             # TODO: to exchange or not to exchange, that is the question, the answer is probably YES
@@ -419,43 +716,23 @@ class DecaModule(LightningModule):
             raise RuntimeError("Invalid image batch dimensions.")
 
         # [B, K, 3, size, size] ==> [BxK, 3, size, size]
-        images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
-
-        if 'landmark' in batch.keys():
-            lmk = batch['landmark']
-            lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+        images = _flatten_ring(images, 3)
 
-        if 'mask' in batch.keys():
-            masks = batch['mask']
-            masks = masks.view(-1, images.shape[-2], images.shape[-1])
+        # each of the optional GT entries is looked up in the batch only once (and is None if not present)
+        lmk = _flatten_ring(batch.get('landmark', None), 2)
+        masks = _flatten_ring(batch.get('mask', None), 2)
 
         # valence / arousal - not necessary unless we want to use VA for supervision (not done in EMOCA)
-        if 'va' in batch:
-            va = batch['va']
-            va = va.view(-1, va.shape[-1])
-        else:
-            va = None
+        va = _flatten_ring(batch.get('va', None), 1)
 
         # 7 basic expression - not necessary unless we want to use expression for supervision (not done in EMOCA or DECA)
-        if 'expr7' in batch:
-            expr7 = batch['expr7']
-            expr7 = expr7.view(-1, expr7.shape[-1])
-        else:
-            expr7 = None
+        expr7 = _flatten_ring(batch.get('expr7', None), 1)
 
         # affectnet basic expression - not necessary unless we want to use expression for supervision (not done in EMOCA or DECA)
-        if 'affectnetexp' in batch:
-            affectnetexp = batch['affectnetexp']
-            affectnetexp = affectnetexp.view(-1, affectnetexp.shape[-1])
-        else:
-            affectnetexp = None
+        affectnetexp = _flatten_ring(batch.get('affectnetexp', None), 1)
 
         # expression weights if supervising by expression is used (to balance the classification loss) - not done in EMOCA or DECA
-        if 'expression_weight' in batch:
-            exprw = batch['expression_weight']
-            exprw = exprw.view(-1, exprw.shape[-1])
-        else:
-            exprw = None
+        exprw = _flatten_ring(batch.get('expression_weight', None), 1)
 
 
         # 1) COARSE STAGE
@@ -487,26 +764,24 @@ class DecaModule(LightningModule):
                     '''
                     # new_order = np.array([np.random.permutation(self.deca.config.train_K) + i * self.deca.config.train_K for i in range(self.deca.config.batch_size_train)])
                     # new_order = np.array([np.random.permutation(self.deca.config.train_K) + i * self.deca.config.train_K for i in range(original_batch_size)])
-                    new_order = np.array([np.random.permutation(K) + i * K for i in range(original_batch_size)])
-                    new_order = new_order.flatten()
+                    new_order = _ring_permutation(original_batch_size, K, shapecode.device)
                     shapecode_new = shapecode[new_order]
                     ## append new shape code data
                     shapecode = torch.cat([shapecode, shapecode_new], dim=0)
-                    texcode = torch.cat([texcode, texcode], dim=0)
-                    expcode = torch.cat([expcode, expcode], dim=0)
-                    posecode = torch.cat([posecode, posecode], dim=0)
-                    cam = torch.cat([cam, cam], dim=0)
-                    lightcode = torch.cat([lightcode, lightcode], dim=0)
+                    texcode = _duplicate(texcode)
+                    expcode = _duplicate(expcode)
+                    posecode = _duplicate(posecode)
+                    cam = _duplicate(cam)
+                    lightcode = _duplicate(lightcode)
                     ## append gt
-                    images = torch.cat([images, images],
-                                       dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
-                    lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-                    masks = torch.cat([masks, masks], dim=0)
+                    images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+                    lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+                    masks = _duplicate(masks)
 
                     if va is not None:
-                        va = torch.cat([va, va], dim=0)
+                        va = _duplicate(va)
                     if expr7 is not None:
-                        expr7 = torch.cat([expr7, expr7], dim=0)
+                        expr7 = _duplicate(expr7)
                 elif self.deca.config.shape_constrain_type == 'shuffle_expression':
                     ## DEPRECATED, NOT USED IN EMOCA OR DECA
                     new_order = np.random.permutation(K*original_batch_size)
@@ -523,21 +798,20 @@ class DecaModule(LightningModule):
                     jaw_pose = posecode[:, 3:]
                     jaw_pose_new = jaw_pose[new_order]
                     jaw_pose = torch.cat([jaw_pose, jaw_pose_new], dim=0)
-                    global_pose = torch.cat([global_pose, global_pose], dim=0)
+                    global_pose = _duplicate(global_pose)
                     posecode = torch.cat([global_pose, jaw_pose], dim=1)
 
                     ## duplicate the rest
-                    shapecode = torch.cat([shapecode, shapecode], dim=0)
-                    texcode = torch.cat([texcode, texcode], dim=0)
-                    cam = torch.cat([cam, cam], dim=0)
-                    lightcode = torch.cat([lightcode, lightcode], dim=0)
+                    shapecode = _duplicate(shapecode)
+                    texcode = _duplicate(texcode)
+                    cam = _duplicate(cam)
+                    lightcode = _duplicate(lightcode)
                     ## duplicate gt if any
-                    images = torch.cat([images, images],
-                                       dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+                    images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
                     print(f"TRAINING: {training}")
                     if lmk is not None:
-                        lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-                    masks = torch.cat([masks, masks], dim=0)
+                        lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+                    masks = _duplicate(masks)
 
                     ref_images_identity_idxs = np.concatenate([old_order, old_order])
                     ref_images_expression_idxs = np.concatenate([old_order, new_order])
@@ -559,17 +833,16 @@ class DecaModule(LightningModule):
                     shapecode_new = shapecode[new_order]
                     ## append new shape code data
                     shapecode = torch.cat([shapecode, shapecode_new], dim=0)
-                    texcode = torch.cat([texcode, texcode], dim=0)
-                    expcode = torch.cat([expcode, expcode], dim=0)
-                    posecode = torch.cat([posecode, posecode], dim=0)
-                    cam = torch.cat([cam, cam], dim=0)
-                    lightcode = torch.cat([lightcode, lightcode], dim=0)
+                    texcode = _duplicate(texcode)
+                    expcode = _duplicate(expcode)
+                    posecode = _duplicate(posecode)
+                    cam = _duplicate(cam)
+                    lightcode = _duplicate(lightcode)
                     ## append gt
-                    images = torch.cat([images, images],
-                                       dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+                    images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
                     if lmk is not None:
-                        lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-                    masks = torch.cat([masks, masks], dim=0)
+                        lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+                    masks = _duplicate(masks)
 
                     ref_images_identity_idxs = np.concatenate([old_order, new_order])
                     ref_images_expression_idxs = np.concatenate([old_order, old_order])
@@ -577,9 +850,9 @@ class DecaModule(LightningModule):
                     codedict["ref_images_expression_idxs"] = ref_images_expression_idxs
 
                     if va is not None:
-                        va = torch.cat([va, va], dim=0)
+                        va = _duplicate(va)
                     if expr7 is not None:
-                        expr7 = torch.cat([expr7, expr7], dim=0)
+                        expr7 = _duplicate(expr7)
 
                 elif 'expression_constrain_type' in self.deca.config.keys() and \
                         self.deca.config.expression_constrain_type == 'same':
@@ -628,30 +901,26 @@ class DecaModule(LightningModule):
                     '''
                     # this creates a per-ring random permutation. The detail exchange happens ONLY between the same
                     # identities (within the ring) but not outside (no cross-identity detail exchange)
-                    new_order = np.array(
-                        # [np.random.permutation(self.deca.config.train_K) + i * self.deca.config.train_K for i in range(original_batch_size)])
-                        [np.random.permutation(K) + i * K for i in range(original_batch_size)])
-                    new_order = new_order.flatten()
+                    new_order = _ring_permutation(original_batch_size, K, detailcode.device)
                     detailcode_new = detailcode[new_order]
                     detailcode = torch.cat([detailcode, detailcode_new], dim=0)
-                    detailemocode = torch.cat([detailemocode, detailemocode], dim=0)
+                    detailemocode = _duplicate(detailemocode)
                     ## append new shape code data
-                    shapecode = torch.cat([shapecode, shapecode], dim=0)
-                    texcode = torch.cat([texcode, texcode], dim=0)
-                    expcode = torch.cat([expcode, expcode], dim=0)
-                    posecode = torch.cat([posecode, posecode], dim=0)
-                    cam = torch.cat([cam, cam], dim=0)
-                    lightcode = torch.cat([lightcode, lightcode], dim=0)
+                    shapecode = _duplicate(shapecode)
+                    texcode = _duplicate(texcode)
+                    expcode = _duplicate(expcode)
+                    posecode = _duplicate(posecode)
+                    cam = _duplicate(cam)
+                    lightcode = _duplicate(lightcode)
                     ## append gt
-                    images = torch.cat([images, images],
-                                       dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
-                    lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-                    masks = torch.cat([masks, masks], dim=0)
+                    images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+                    lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+                    masks = _duplicate(masks)
 
                     if va is not None:
-                        va = torch.cat([va, va], dim=0)
+                        va = _duplicate(va)
                     if expr7 is not None:
-                        expr7 = torch.cat([expr7, expr7], dim=0)
+                        expr7 = _duplicate(expr7)
 
                 elif self.deca.config.detail_constrain_type == 'shuffle_expression':
                     ## Deprecated and not used in EMOCA or DECA
@@ -667,29 +936,28 @@ class DecaModule(LightningModule):
                     # exchange emotion code, but not (identity-based) detailcode
                     detailemocode_new = detailemocode[new_order]
                     detailemocode = torch.cat([detailemocode, detailemocode_new], dim=0)
-                    detailcode = torch.cat([detailcode, detailcode], dim=0)
+                    detailcode = _duplicate(detailcode)
 
                     # exchange jaw pose (but not global pose)
                     global_pose = posecode[:, :3]
                     jaw_pose = posecode[:, 3:]
                     jaw_pose_new = jaw_pose[new_order]
                     jaw_pose = torch.cat([jaw_pose, jaw_pose_new], dim=0)
-                    global_pose = torch.cat([global_pose, global_pose], dim=0)
+                    global_pose = _duplicate(global_pose)
                     posecode = torch.cat([global_pose, jaw_pose], dim=1)
 
 
                     ## duplicate the rest
-                    shapecode = torch.cat([shapecode, shapecode], dim=0)
-                    texcode = torch.cat([texcode, texcode], dim=0)
-                    cam = torch.cat([cam, cam], dim=0)
-                    lightcode = torch.cat([lightcode, lightcode], dim=0)
+                    shapecode = _duplicate(shapecode)
+                    texcode = _duplicate(texcode)
+                    cam = _duplicate(cam)
+                    lightcode = _duplicate(lightcode)
                     ## duplicate gt if any
-                    images = torch.cat([images, images],
-                                       dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+                    images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
                     print(f"TRAINING: {training}")
                     if lmk is not None:
-                        lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-                    masks = torch.cat([masks, masks], dim=0)
+                        lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+                    masks = _duplicate(masks)
 
                     ref_images_identity_idxs = np.concatenate([old_order, old_order])
                     ref_images_expression_idxs = np.concatenate([old_order, new_order])
@@ -715,19 +983,18 @@ class DecaModule(LightningModule):
                     # exchange (identity-based) detailcode, but not emotion code
                     detailcode_new = detailcode[new_order]
                     detailcode = torch.cat([detailcode, detailcode_new], dim=0)
-                    detailemocode = torch.cat([detailemocode, detailemocode], dim=0)
+                    detailemocode = _duplicate(detailemocode)
 
-                    texcode = torch.cat([texcode, texcode], dim=0)
-                    expcode = torch.cat([expcode, expcode], dim=0)
-                    posecode = torch.cat([posecode, posecode], dim=0)
-                    cam = torch.cat([cam, cam], dim=0)
-                    lightcode = torch.cat([lightcode, lightcode], dim=0)
+                    texcode = _duplicate(texcode)
+                    expcode = _duplicate(expcode)
+                    posecode = _duplicate(posecode)
+                    cam = _duplicate(cam)
+                    lightcode = _duplicate(lightcode)
                     ## append gt
-                    images = torch.cat([images, images],
-                                       dim=0)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+                    images = _duplicate(images)  # images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
                     if lmk is not None:
-                        lmk = torch.cat([lmk, lmk], dim=0)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-                    masks = torch.cat([masks, masks], dim=0)
+                        lmk = _duplicate(lmk)  # lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+                    masks = _duplicate(masks)
 
                     ref_images_identity_idxs = np.concatenate([old_order, new_order])
                     ref_images_expression_idxs = np.concatenate([old_order, old_order])
@@ -735,9 +1002,9 @@ class DecaModule(LightningModule):
                     codedict["ref_images_expression_idxs"] = ref_images_expression_idxs
 
                     if va is not None:
-                        va = torch.cat([va, va], dim=0)
+                        va = _duplicate(va)
                     if expr7 is not None:
-                        expr7 = torch.cat([expr7, expr7], dim=0)
+                        expr7 = _duplicate(expr7)
 
                 elif 'expression_constrain_type' in self.deca.config.keys() and \
                         self.deca.config.expression_constrain_type == 'exchange':
@@ -757,20 +1024,10 @@ class DecaModule(LightningModule):
             codedict['detailcode'] = detailcode
             codedict['detailemocode'] = detailemocode
         codedict['images'] = images
-        if 'mask' in batch.keys():
-            codedict['masks'] = masks
-        if 'landmark' in batch.keys():
-            codedict['lmk'] = lmk
-
-        if 'va' in batch.keys():
-            codedict['va'] = va
-        if 'expr7' in batch.keys():
-            codedict['expr7'] = expr7
-        if 'affectnetexp' in batch.keys():
-            codedict['affectnetexp'] = affectnetexp
-
-        if 'expression_weight' in batch.keys():
-            codedict['expression_weight'] = exprw
+        for key, value in (('masks', masks), ('lmk', lmk), ('va', va), ('expr7', expr7),
+                           ('affectnetexp', affectnetexp), ('expression_weight', exprw)):
+            if value is not None:
+                codedict[key] = value
 
         return codedict
 
@@ -797,6 +1054,60 @@ class DecaModule(LightningModule):
         return detail_conditioning_list
 
 
+    def _expand_to_batch(self, name, tensor, batch_size):
+        """
+        Returns the constant tensor (with a leading singleton dimension) expanded to the given batch size. The expanded
+        contiguous copy is cached and sliced on subsequent calls, so that it is not materialized in every forward pass.
+        The cache is invalidated if the source tensor changes (i.e. after moving the model or reconfiguring it).
+        """
+        cached = self._batch_expansion_cache.get(name, None)
+        if cached is None or cached[0] is not tensor or cached[1].shape[0] < batch_size:
+            expanded = tensor.expand(batch_size, *tensor.shape[1:]).contiguous()
+            self._batch_expansion_cache[name] = (tensor, expanded)
+            return expanded
+        return cached[1][:batch_size]
+
+    def _zero_target_domain(self, batch_size):
+        """
+        Returns the (all zero) target domain of the image translator for the given batch size. The buffer only grows
+        when a larger batch is encountered and is sliced otherwise.
+        """
+        if self._zero_domain.shape[0] < batch_size or \
+                (self._zero_domain.is_inference() and not torch.is_inference_mode_enabled()):
+            self._zero_domain = torch.zeros(batch_size, dtype=torch.int64, device=self._zero_domain.device)
+        return self._zero_domain[:batch_size]
+
+    def _concat_detail_conditioning(self, conditioning_list):
+        """
+        Concatenates the detail conditioning list into the input of the detail generator. If no gradient is required
+        (i.e. inference), the result is written into a preallocated buffer that is reused across forward passes.
+        """
+        if torch.is_grad_enabled() and any(c.requires_grad for c in conditioning_list):
+            return torch.cat(conditioning_list, dim=1)
+        batch_size = conditioning_list[0].shape[0]
+        dim = sum(c.shape[1] for c in conditioning_list)
+        buffer = self._detail_conditioning_buffer
+        if buffer is None or buffer.shape[0] < batch_size or buffer.shape[1] != dim \
+                or buffer.device != conditioning_list[0].device or buffer.dtype != conditioning_list[0].dtype \
+                or buffer.is_inference() != torch.is_inference_mode_enabled():
+            buffer = torch.empty(batch_size, dim, device=conditioning_list[0].device, dtype=conditioning_list[0].dtype)
+            self._detail_conditioning_buffer = buffer
+        return torch.cat(conditioning_list, dim=1, out=buffer[:batch_size])
+
+    def _apply_background(self, rendered, images, masks):
+        """
+        Composites the rendered image with the background according to the 'background_from_input' config.
+        :param rendered: the rendered images
+        :param images: the input images (resized to the rendering resolution if need be)
+        :param masks: the segmentation masks
+        """
+        if self._background_mode == BackgroundMode.NONE:
+            # the background is not handled, nothing to composite
+            return rendered
+        if self._background_mode == BackgroundMode.INPUT:
+            return _composite_background(images, masks, rendered)
+        return masks * rendered
+
     def decode(self, codedict, training=True, **kwargs) -> dict:
         """
         Forward decoding pass of the model. Takes the latent code predicted by the encoding stage and reconstructs and renders the shape.
@@ -810,23 +1121,19 @@ class DecaModule(LightningModule):
         cam = codedict['cam']
         lightcode = codedict['lightcode']
         images = codedict['images']
-        if 'masks' in codedict.keys():
-            masks = codedict['masks']
-        else:
-            masks = None
+        masks = codedict.get('masks', None)
 
         effective_batch_size = images.shape[0]  # this is the current batch size after all training augmentations modifications
 
         # 1) Reconstruct the face mesh
-        # FLAME - world space
-        verts, landmarks2d, landmarks3d = self.deca.flame(shape_params=shapecode, expression_params=expcode,
-                                                          pose_params=posecode)
-        # world to camera
-        trans_verts = util.batch_orth_proj(verts, cam)
-        predicted_landmarks = util.batch_orth_proj(landmarks2d, cam)[:, :, :2]
-        # camera to image space
-        trans_verts[:, :, 1:] = -trans_verts[:, :, 1:]
-        predicted_landmarks[:, :, 1:] = - predicted_landmarks[:, :, 1:]
+        # the geometry is always computed in full precision (even if mixed precision is used), for numerical stability
+        with torch.cuda.amp.autocast(enabled=False):
+            # FLAME - world space
+            verts, landmarks2d, landmarks3d = self.deca.flame(shape_params=shapecode.float(), expression_params=expcode.float(),
+                                                              pose_params=posecode.float())
+            # world to camera to image space (the y and z flip is done within the projection)
+            trans_verts = util.batch_orth_proj(verts, cam.float(), flip_yz=True)
+            predicted_landmarks = util.batch_orth_proj(landmarks2d, cam.float(), flip_yz=True)[:, :, :2]
 
         if self.uses_texture():
             albedo = self.deca.flametex(texcode)
@@ -836,72 +1143,72 @@ class DecaModule(LightningModule):
 
         # 2) Render the coarse image
         ops = self.deca.render(verts, trans_verts, albedo, lightcode)
-        # mask
-        mask_face_eye = F.grid_sample(self.deca.uv_face_eye_mask.expand(effective_batch_size, -1, -1, -1),
-                                      ops['grid'].detach(),
-                                      align_corners=False)
         # images
         predicted_images = ops['images']
         # predicted_images = ops['images'] * mask_face_eye * ops['alpha_images']
         # predicted_images_no_mask = ops['images'] #* mask_face_eye * ops['alpha_images']
-        segmentation_type = None
-        if isinstance(self.deca.config.useSeg, bool):
-            if self.deca.config.useSeg:
-                segmentation_type = 'gt'
-            else:
-                segmentation_type = 'rend'
-        elif isinstance(self.deca.config.useSeg, str):
-            segmentation_type = self.deca.config.useSeg
-        else:
-            raise RuntimeError(f"Invalid 'useSeg' type: '{type(self.deca.config.useSeg)}'")
-
-        if segmentation_type not in ["gt", "rend", "intersection", "union"]:
-            raise ValueError(f"Invalid segmentation type for masking '{segmentation_type}'")
-
+        segmentation_type = self._segmentation_type
         if masks is None: # if mask not provided, the only mask available is the rendered one
-            segmentation_type = 'rend'
+            segmentation_type = SegmentationType.REND
 
-        elif masks.shape[-1] != predicted_images.shape[-1] or masks.shape[-2] != predicted_images.shape[-2]:
+        # mask of the rendered face region, only needed for the rendered segmentation types and the identity loss
+        if segmentation_type != SegmentationType.GT or self.deca.id_loss is not None:
+            mask_face_eye = F.grid_sample(self._expand_to_batch('uv_face_eye_mask', self.deca.uv_face_eye_mask, effective_batch_size),
+                                          ops['grid'].detach(),
+                                          align_corners=False)
+        else:
+            mask_face_eye = None
+
+        if masks is not None and \
+                (masks.shape[-1] != predicted_images.shape[-1] or masks.shape[-2] != predicted_images.shape[-2]):
             # resize masks if need be (this is only done if configuration was changed at some point after training)
             dims = masks.ndim == 3
             if dims:
                 masks = masks[:, None, :, :]
-            masks = F.interpolate(masks, size=predicted_images.shape[-2:], mode='bilinear')
+            # nearest neighbour keeps the masks binary (and is cheaper than bilinear)
+            masks = F.interpolate(masks, size=predicted_images.shape[-2:], mode='nearest')
             if dims:
                 masks = masks[:, 0, ...]
 
+        # the input images at the rendering resolution are only needed if the background is taken from the input
+        # and for the texture extraction of the detail stage
+        if self._background_mode != BackgroundMode.INPUT and self.mode != DecaMode.DETAIL:
+            images_resized = None
         # resize images if need be (this is only done if configuration was changed at some point after training)
-        if images.shape[-1] != predicted_images.shape[-1] or images.shape[-2] != predicted_images.shape[-2]:
+        elif images.shape[-1] != predicted_images.shape[-1] or images.shape[-2] != predicted_images.shape[-2]:
             ## special case only for inference time if the rendering image sizes have been changed
             images_resized = F.interpolate(images, size=predicted_images.shape[-2:], mode='bilinear')
         else:
             images_resized = images
 
+        channels_last = 'channels_last' in self.deca.config.keys() and self.deca.config.channels_last
+        if channels_last:
+            # channels last memory format enables faster (vectorized / tensor core) kernels for the compositing and
+            # the subsequent image losses on recent GPUs
+            # the input images are also the reference of the image losses
+            images = images.contiguous(memory_format=torch.channels_last)
+            codedict['images'] = images
+            if images_resized is not None:
+                images_resized = images_resized.contiguous(memory_format=torch.channels_last)
+            predicted_images = predicted_images.contiguous(memory_format=torch.channels_last)
+            ops['alpha_images'] = ops['alpha_images'].contiguous(memory_format=torch.channels_last)
+            if mask_face_eye is not None:
+                mask_face_eye = mask_face_eye.contiguous(memory_format=torch.channels_last)
+            if masks is not None and masks.ndim == 4:
+                masks = masks.contiguous(memory_format=torch.channels_last)
+
         # what type of segmentation we use
-        if segmentation_type == "gt": # GT stands for external segmetnation predicted by face parsing or similar
+        if segmentation_type == SegmentationType.GT: # GT stands for external segmetnation predicted by face parsing or similar
             masks = masks[:, None, :, :]
-        elif segmentation_type == "rend": # mask rendered as a silhouette of the face mesh
+        elif segmentation_type == SegmentationType.REND: # mask rendered as a silhouette of the face mesh
             masks = mask_face_eye * ops['alpha_images']
-        elif segmentation_type == "intersection": # intersection of the two above
+        elif segmentation_type == SegmentationType.INTERSECTION: # intersection of the two above
             masks = masks[:, None, :, :] * mask_face_eye * ops['alpha_images']
-        elif segmentation_type == "union": # union of the first two options
-            masks = torch.max(masks[:, None, :, :],  mask_face_eye * ops['alpha_images'])
-        else:
-            raise RuntimeError(f"Invalid segmentation type for masking '{segmentation_type}'")
+        else: # union of the first two options
+            masks = _mask_union(masks[:, None, :, :], mask_face_eye, ops['alpha_images'])
 
 
-        if self.deca.config.background_from_input in [True, "input"]:
-            if images.shape[-1] != predicted_images.shape[-1] or images.shape[-2] != predicted_images.shape[-2]:
-                ## special case only for inference time if the rendering image sizes have been changed
-                predicted_images = (1. - masks) * images_resized + masks * predicted_images
-            else:
-                predicted_images = (1. - masks) * images + masks * predicted_images
-        elif self.deca.config.background_from_input in [False, "black"]:
-            predicted_images = masks * predicted_images
-        elif self.deca.config.background_from_input in ["none"]:
-            predicted_images = predicted_images
-        else:
-            raise ValueError(f"Invalid type of background modification {self.deca.config.background_from_input}")
+        predicted_images = self._apply_background(predicted_images, images_resized, masks)
 
         # 3) Render the detail image
         if self.mode == DecaMode.DETAIL:
@@ -916,7 +1223,7 @@ class DecaModule(LightningModule):
 
             # b) Pass the detail code and the conditions through the detail generator to get displacement UV map
             if isinstance(self.deca.D_detail, Generator):
-                uv_z = self.deca.D_detail(torch.cat(final_detail_conditioning_list, dim=1))
+                uv_z = self.deca.D_detail(self._concat_detail_conditioning(final_detail_conditioning_list))
             elif isinstance(self.deca.D_detail, GeneratorAdaIn):
                 uv_z = self.deca.D_detail(z=torch.cat([detailcode, detailemocode], dim=1),
                                           cond=torch.cat(final_detail_conditioning_list, dim=1))
@@ -943,34 +1250,25 @@ class DecaModule(LightningModule):
                 # if the grid is detached, the gradient of the positions of UV-values in image space won't flow back to the geometry
                 grid = grid.detach()
             predicted_detailed_image = F.grid_sample(uv_texture, grid, align_corners=False)
-            if self.deca.config.background_from_input in [True, "input"]:
-                if images.shape[-1] != predicted_images.shape[-1] or images.shape[-2] != predicted_images.shape[-2]:
-                    ## special case only for inference time if the rendering image sizes have been changed
-                    # images_resized = F.interpolate(images, size=predicted_images.shape[-2:], mode='bilinear')
-                    ## before bugfix
-                    # predicted_images = (1. - masks) * images_resized + masks * predicted_images
-                    ## after bugfix
-                    predicted_detailed_image = (1. - masks) * images_resized + masks * predicted_detailed_image
-                else:
-                    predicted_detailed_image = (1. - masks) * images + masks * predicted_detailed_image
-            elif self.deca.config.background_from_input in [False, "black"]:
-                predicted_detailed_image = masks * predicted_detailed_image
-            elif self.deca.config.background_from_input in ["none"]:
-                predicted_detailed_image = predicted_detailed_image
-            else:
-                raise ValueError(f"Invalid type of background modification {self.deca.config.background_from_input}")
+            predicted_detailed_image = self._apply_background(predicted_detailed_image, images_resized, masks)
+            if channels_last:
+                predicted_detailed_image = predicted_detailed_image.contiguous(memory_format=torch.channels_last)
 
 
             # --- extract texture
-            uv_pverts = self.deca.render.world2uv(trans_verts).detach()
-            uv_gt = F.grid_sample(torch.cat([images_resized, masks], dim=1), uv_pverts.permute(0, 2, 3, 1)[:, :, :, :2],
+            normals = util.vertex_normals(trans_verts, self._expand_to_batch('faces', self.deca.render.faces, effective_batch_size))
+            # the vertices and normals are projected to uv space in a single rasterization pass
+            # (neither of them needs gradient - the vertices are detached and the normals only used for a binary mask)
+            uv_pverts_pnorm = self.deca.render.world2uv(torch.cat([trans_verts, normals], dim=-1).detach())
+            uv_pverts = uv_pverts_pnorm[:, :3]
+            uv_pnorm = uv_pverts_pnorm[:, 3:]
+            # the sampling grid is materialized once (contiguous) and reused by every grid_sample below
+            uv_grid = uv_pverts[:, :2].permute(0, 2, 3, 1).contiguous()
+            uv_gt = F.grid_sample(torch.cat([images_resized, masks], dim=1), uv_grid,
                                   mode='bilinear')
             uv_texture_gt = uv_gt[:, :3, :, :].detach()
             uv_mask_gt = uv_gt[:, 3:, :, :].detach()
             # self-occlusion
-            normals = util.vertex_normals(trans_verts, self.deca.render.faces.expand(effective_batch_size, -1, -1))
-            uv_pnorm = self.deca.render.world2uv(normals)
-
             uv_mask = (uv_pnorm[:, -1, :, :] < -0.05).float().detach()
             uv_mask = uv_mask[:, None, :, :]
             ## combine masks
@@ -983,29 +1281,29 @@ class DecaModule(LightningModule):
         ## 4) (Optional) NEURAL RENDERING - not used in neither DECA nor EMOCA
         # If neural rendering is enabled, the differentiable rendered synthetic images are translated using an image translation net (such as StarGan)
         if self.deca._has_neural_rendering():
-            predicted_translated_image = self.deca.image_translator(
+            if self.mode == DecaMode.DETAIL:
+                # translate the coarse and detailed images in a single batched pass
+                translator_input = torch.cat([predicted_images, predicted_detailed_image], dim=0)
+                translator_ref = images.repeat(2, 1, 1, 1)
+            else:
+                translator_input = predicted_images
+                translator_ref = images
+            translated_images = self.deca.image_translator(
                 {
-                    "input_image" : predicted_images,
-                    "ref_image" : images,
-                    "target_domain" : torch.tensor([0]*predicted_images.shape[0],
-                                                   dtype=torch.int64, device=predicted_images.device)
+                    "input_image" : translator_input,
+                    "ref_image" : translator_ref,
+                    "target_domain" : self._zero_target_domain(translator_input.shape[0])
                 }
             )
 
             if self.mode == DecaMode.DETAIL:
-                predicted_detailed_translated_image = self.deca.image_translator(
-                        {
-                            "input_image" : predicted_detailed_image,
-                            "ref_image" : images,
-                            "target_domain" : torch.tensor([0]*predicted_detailed_image.shape[0],
-                                                           dtype=torch.int64, device=predicted_detailed_image.device)
-                        }
-                    )
-                translated_uv = F.grid_sample(torch.cat([predicted_detailed_translated_image, masks], dim=1), uv_pverts.permute(0, 2, 3, 1)[:, :, :, :2],
-                                      mode='bilinear')
-                translated_uv_texture = translated_uv[:, :3, :, :].detach()
+                predicted_translated_image, predicted_detailed_translated_image = translated_images.chunk(2, dim=0)
+                # only the texture is needed, the mask channels would be discarded
+                translated_uv_texture = F.grid_sample(predicted_detailed_translated_image, uv_grid,
+                                                      mode='bilinear').detach()
 
             else:
+                predicted_translated_image = translated_images
                 predicted_detailed_translated_image = None
 
                 translated_uv_texture = None
@@ -1022,31 +1320,35 @@ class DecaModule(LightningModule):
             codedict = self.emotion_mlp(codedict, "emo_mlp_")
 
         # populate the value dict for metric computation/visualization
-        codedict['predicted_images'] = predicted_images
-        codedict['predicted_detailed_image'] = predicted_detailed_image
-        codedict['predicted_translated_image'] = predicted_translated_image
-        codedict['verts'] = verts
-        codedict['albedo'] = albedo
-        codedict['mask_face_eye'] = mask_face_eye
-        codedict['landmarks2d'] = landmarks2d
-        codedict['landmarks3d'] = landmarks3d
-        codedict['predicted_landmarks'] = predicted_landmarks
-        codedict['trans_verts'] = trans_verts
-        codedict['ops'] = ops
-        codedict['masks'] = masks
-        codedict['normals'] = ops['normals']
+        codedict.update({
+            'predicted_images': predicted_images,
+            'predicted_detailed_image': predicted_detailed_image,
+            'predicted_translated_image': predicted_translated_image,
+            'verts': verts,
+            'albedo': albedo,
+            'mask_face_eye': mask_face_eye,
+            'landmarks2d': landmarks2d,
+            'landmarks3d': landmarks3d,
+            'predicted_landmarks': predicted_landmarks,
+            'trans_verts': trans_verts,
+            'ops': ops,
+            'masks': masks,
+            'normals': ops['normals'],
+        })
 
         if self.mode == DecaMode.DETAIL:
-            codedict['predicted_detailed_translated_image'] = predicted_detailed_translated_image
-            codedict['translated_uv_texture'] = translated_uv_texture
-            codedict['uv_texture_gt'] = uv_texture_gt
-            codedict['uv_texture'] = uv_texture
-            codedict['uv_detail_normals'] = uv_detail_normals
-            codedict['uv_z'] = uv_z
-            codedict['uv_shading'] = uv_shading
-            codedict['uv_vis_mask'] = uv_vis_mask
-            codedict['uv_mask'] = uv_mask
-            codedict['displacement_map'] = uv_z + self.deca.fixed_uv_dis[None, None, :, :]
+            codedict.update({
+                'predicted_detailed_translated_image': predicted_detailed_translated_image,
+                'translated_uv_texture': translated_uv_texture,
+                'uv_texture_gt': uv_texture_gt,
+                'uv_texture': uv_texture,
+                'uv_detail_normals': uv_detail_normals,
+                'uv_z': uv_z,
+                'uv_shading': uv_shading,
+                'uv_vis_mask': uv_vis_mask,
+                'uv_mask': uv_mask,
+                'displacement_map': uv_z + self.deca.fixed_uv_dis,  # [H, W] broadcasts over batch and channels
+            })
 
         return codedict
 
@@ -1058,48 +1360,55 @@ class DecaModule(LightningModule):
             else:
                 loss_dict[name] = loss
 
-        # if self.deca.config.use_emonet_loss:
-        if with_grad:
-            d = loss_dict
-            emo_feat_loss_1, emo_feat_loss_2, valence_loss, arousal_loss, expression_loss, au_loss = \
-                self.emonet_loss.compute_loss(images, predicted_images, batch_size=batch_size, ring_size=ring_size)
-        else:
-            d = metric_dict
-            with torch.no_grad():
+        # metric-only terms are computed entirely without autograd (including the weighting and logging below)
+        with torch.set_grad_enabled(torch.is_grad_enabled() and with_grad):
+            # if self.deca.config.use_emonet_loss:
+            d = loss_dict if with_grad else metric_dict
+            with self._metric_autocast(with_grad):
+                # the coarse, detail (and translated) terms all compare against the same input images, so their
+                # emotion is only computed once per loss computation. It is only reused under the same autocast state
+                # (a reference computed in half precision for a metric must not be used for a loss term)
+                autocast_state = _autocast_state()
+                if self._reference_emotion is not None and self._reference_emotion[0] is images \
+                        and self._reference_emotion[1] == autocast_state:
+                    input_emotion = self._reference_emotion[2]
+                else:
+                    input_emotion = None
                 emo_feat_loss_1, emo_feat_loss_2, valence_loss, arousal_loss, expression_loss, au_loss = \
-                    self.emonet_loss.compute_loss(images, predicted_images, batch_size=batch_size, ring_size=ring_size)
-
-
-
-        # EmoNet self-consistency loss terms
-        if emo_feat_loss_1 is not None:
-            loss_or_metric(prefix + '_emonet_feat_1_L1', emo_feat_loss_1 * self.deca.config.emonet_weight,
-                           self.deca.config.use_emonet_feat_1 and self.deca.config.use_emonet_loss)
-        loss_or_metric(prefix + '_emonet_feat_2_L1', emo_feat_loss_2 * self.deca.config.emonet_weight,
-                       self.deca.config.use_emonet_feat_2 and self.deca.config.use_emonet_loss)
-        loss_or_metric(prefix + '_emonet_valence_L1', valence_loss * self.deca.config.emonet_weight,
-                       self.deca.config.use_emonet_valence and self.deca.config.use_emonet_loss)
-        loss_or_metric(prefix + '_emonet_arousal_L1', arousal_loss * self.deca.config.emonet_weight,
-                       self.deca.config.use_emonet_arousal and self.deca.config.use_emonet_loss)
-        # loss_or_metric(prefix + 'emonet_expression_KL', expression_loss * self.deca.config.emonet_weight) # KL seems to be causing NaN's
-        loss_or_metric(prefix + '_emonet_expression_L1',expression_loss * self.deca.config.emonet_weight,
-                       self.deca.config.use_emonet_expression and self.deca.config.use_emonet_loss)
-        loss_or_metric(prefix + '_emonet_combined', ((emo_feat_loss_1 if emo_feat_loss_1 is not None else 0)
-                                                     + emo_feat_loss_2 + valence_loss + arousal_loss + expression_loss) * self.deca.config.emonet_weight,
-                       self.deca.config.use_emonet_combined and self.deca.config.use_emonet_loss)
-
-        # Log also the VA
-        metric_dict[prefix + "_valence_input"] = self.emonet_loss.input_emotion['valence'].mean().detach()
-        metric_dict[prefix + "_valence_output"] = self.emonet_loss.output_emotion['valence'].mean().detach()
-        metric_dict[prefix + "_arousal_input"] = self.emonet_loss.input_emotion['arousal'].mean().detach()
-        metric_dict[prefix + "_arousal_output"] = self.emonet_loss.output_emotion['arousal'].mean().detach()
-
-        input_ex = self.emonet_loss.input_emotion['expression' if 'expression' in self.emonet_loss.input_emotion.keys() else 'expr_classification'].detach().cpu().numpy()
-        input_ex = np.argmax(input_ex, axis=1).mean()
-        output_ex = self.emonet_loss.output_emotion['expression' if 'expression' in self.emonet_loss.input_emotion.keys() else 'expr_classification'].detach().cpu().numpy()
-        output_ex = np.argmax(output_ex, axis=1).mean()
-        metric_dict[prefix + "_expression_input"] = torch.tensor(input_ex, device=self.device)
-        metric_dict[prefix + "_expression_output"] = torch.tensor(output_ex, device=self.device)
+                    self.emonet_loss.compute_loss(images, predicted_images, batch_size=batch_size, ring_size=ring_size,
+                                                  input_emotion=input_emotion)
+            self._reference_emotion = (images, autocast_state, self.emonet_loss.input_emotion)
+
+
+
+            # EmoNet self-consistency loss terms
+            if emo_feat_loss_1 is not None:
+                loss_or_metric(prefix + '_emonet_feat_1_L1', emo_feat_loss_1 * self.deca.config.emonet_weight,
+                               self.deca.config.use_emonet_feat_1 and self.deca.config.use_emonet_loss)
+            loss_or_metric(prefix + '_emonet_feat_2_L1', emo_feat_loss_2 * self.deca.config.emonet_weight,
+                           self.deca.config.use_emonet_feat_2 and self.deca.config.use_emonet_loss)
+            loss_or_metric(prefix + '_emonet_valence_L1', valence_loss * self.deca.config.emonet_weight,
+                           self.deca.config.use_emonet_valence and self.deca.config.use_emonet_loss)
+            loss_or_metric(prefix + '_emonet_arousal_L1', arousal_loss * self.deca.config.emonet_weight,
+                           self.deca.config.use_emonet_arousal and self.deca.config.use_emonet_loss)
+            # loss_or_metric(prefix + 'emonet_expression_KL', expression_loss * self.deca.config.emonet_weight) # KL seems to be causing NaN's
+            loss_or_metric(prefix + '_emonet_expression_L1',expression_loss * self.deca.config.emonet_weight,
+                           self.deca.config.use_emonet_expression and self.deca.config.use_emonet_loss)
+            loss_or_metric(prefix + '_emonet_combined', ((emo_feat_loss_1 if emo_feat_loss_1 is not None else 0)
+                                                         + emo_feat_loss_2 + valence_loss + arousal_loss + expression_loss) * self.deca.config.emonet_weight,
+                           self.deca.config.use_emonet_combined and self.deca.config.use_emonet_loss)
+
+            # Log also the VA
+            metric_dict[prefix + "_valence_input"] = self.emonet_loss.input_emotion['valence'].mean().detach()
+            metric_dict[prefix + "_valence_output"] = self.emonet_loss.output_emotion['valence'].mean().detach()
+            metric_dict[prefix + "_arousal_input"] = self.emonet_loss.input_emotion['arousal'].mean().detach()
+            metric_dict[prefix + "_arousal_output"] = self.emonet_loss.output_emotion['arousal'].mean().detach()
+
+            # the argmax stays on the device (no synchronizing copy to the host just to log a scalar)
+            input_ex = self.emonet_loss.input_emotion[self.emonet_loss.expression_key].detach()
+            output_ex = self.emonet_loss.output_emotion[self.emonet_loss.expression_key].detach()
+            metric_dict[prefix + "_expression_input"] = input_ex.argmax(dim=1).float().mean()
+            metric_dict[prefix + "_expression_output"] = output_ex.argmax(dim=1).float().mean()
 
         # # GT emotion loss terms
         # if self.deca.config.use_gt_emotion_loss:
@@ -1177,6 +1486,49 @@ class DecaModule(LightningModule):
 
 
 
+    def _vgg_loss_stream(self):
+        """
+        Returns the side CUDA stream the VGG loss terms are issued on if the 'vgg_loss_stream' config is set (None
+        otherwise). The VGG terms are independent of the rest of the losses, on a separate stream they can overlap with
+        the identity and emotion networks running on the default stream.
+        """
+        if self.deca.vgg_loss is None or self.device.type != 'cuda' or \
+                'vgg_loss_stream' not in self.deca.config.keys() or not self.deca.config.vgg_loss_stream:
+            return None
+        if self._vgg_stream is None or self._vgg_stream.device != self.device:
+            self._vgg_stream = torch.cuda.Stream(device=self.device)
+        return self._vgg_stream
+
+    def _compute_vgg_loss(self, loss_dict, name, masked_images, masks, predicted_images, weight, stream=None):
+        """
+        VGG feature loss between the masked input and the masked predicted images. If a stream is given, the loss is
+        issued on it and the caller has to make the default stream wait for it before the loss is used.
+        """
+        if stream is None:
+            vggl, _ = self.deca.vgg_loss(masked_images, masks * predicted_images)
+            loss_dict[name] = vggl * weight
+            return
+        stream.wait_stream(torch.cuda.current_stream())
+        # the inputs come from the default stream, their memory must not be reused before the side stream is done
+        for t in (masked_images, masks, predicted_images):
+            t.record_stream(stream)
+        with torch.cuda.stream(stream):
+            vggl, _ = self.deca.vgg_loss(masked_images, masks * predicted_images)
+            loss_dict[name] = vggl * weight
+
+    def _metric_autocast(self, with_grad):
+        """
+        Autocast context for the deep (perceptual, emotion) networks when they only compute metrics. Gradient-free
+        evaluations can run in half precision without loss scaling. Enabled by the 'autocast_metrics' config (only has
+        an effect on GPU, with precision=16 training everything is autocast already).
+        """
+        if torch.is_autocast_enabled():
+            # an already active autocast (precision=16) must not be switched off or changed to another dtype
+            return torch.cuda.amp.autocast(enabled=True, **_autocast_dtype_kwargs())
+        enabled = not with_grad and self.device.type == 'cuda' and \
+                  'autocast_metrics' in self.deca.config.keys() and bool(self.deca.config.autocast_metrics)
+        return torch.cuda.amp.autocast(enabled=enabled)
+
     def _metric_or_loss(self, loss_dict, metric_dict, is_loss):
         if is_loss:
             d = loss_dict
@@ -1196,11 +1548,13 @@ class DecaModule(LightningModule):
             mask_face_eye = codedict["mask_face_eye"]
 
             shading_images = self.deca.render.add_SHlight(ops['normal_images'], codedict["lightcode"].detach())
+            # only the albedo is detached, the gradient still flows to the geometry through the grid
             albedo_images = F.grid_sample(codedict["albedo"].detach(), ops['grid'], align_corners=False)
 
             # TODO: get to the bottom of this weird overlay thing - why is it there?
             # answer: This renders the face and takes background from the image
-            overlay = albedo_images * shading_images * mask_face_eye + images * (1 - mask_face_eye)
+            # (the same fused compositing as the background handling in decode, no (1 - mask) temporaries)
+            overlay = _composite_background(images, mask_face_eye, albedo_images * shading_images)
 
             if self.global_step >= self.deca.id_loss_start_step:
                 if 'id_metric' in self.deca.config.keys() and 'barlow_twins' in self.deca.config.id_metric:
@@ -1329,12 +1683,10 @@ class DecaModule(LightningModule):
 
             codedict[f"{prefix}_valence_input"] = self.emonet_loss.input_emotion['valence']
             codedict[f"{prefix}_arousal_input"] = self.emonet_loss.input_emotion['arousal']
-            codedict[f"{prefix}_expression_input"] = self.emonet_loss.input_emotion[
-                'expression' if 'expression' in self.emonet_loss.input_emotion.keys() else 'expr_classification']
+            codedict[f"{prefix}_expression_input"] = self.emonet_loss.input_emotion[self.emonet_loss.expression_key]
             codedict[f"{prefix}_valence_output"] = self.emonet_loss.output_emotion['valence']
             codedict[f"{prefix}_arousal_output"] = self.emonet_loss.output_emotion['arousal']
-            codedict[f"{prefix}_expression_output"] = self.emonet_loss.output_emotion[
-                'expression' if 'expression' in self.emonet_loss.input_emotion.keys() else 'expr_classification']
+            codedict[f"{prefix}_expression_output"] = self.emonet_loss.output_emotion[self.emonet_loss.expression_key]
 
             if 'emo_contrastive' in self.deca.config.keys() and self.deca.config.emo_contrastive:
                 assert ring_size == 2 or ring_size == 1
@@ -1461,8 +1813,7 @@ class DecaModule(LightningModule):
                 # codedict[f"{prefix}_expression_input"] = self.emonet_loss.input_emotion['expression']
                 codedict[f"{prefix}_translated_valence_output"] = self.emonet_loss.output_emotion['valence']
                 codedict[f"{prefix}_translated_arousal_output"] = self.emonet_loss.output_emotion['arousal']
-                codedict[f"{prefix}_translated_expression_output"] = self.emonet_loss.output_emotion[
-                    'expression' if 'expression' in self.emonet_loss.input_emotion.keys() else 'expr_classification']
+                codedict[f"{prefix}_translated_expression_output"] = self.emonet_loss.output_emotion[self.emonet_loss.expression_key]
         return losses, metrics, codedict
 
 
@@ -1470,6 +1821,7 @@ class DecaModule(LightningModule):
         #### ----------------------- Losses
         losses = {}
         metrics = {}
+        self._reference_emotion = None
 
         predicted_landmarks = codedict["predicted_landmarks"]
         if "lmk" in codedict.keys():
@@ -1517,6 +1869,21 @@ class DecaModule(LightningModule):
             uv_texture = codedict["uv_texture"]
             uv_texture_gt = codedict["uv_texture_gt"]
 
+        # the scalar loss weights used repeatedly below, read from the config once
+        photow = float(self.deca.config.photow) if 'photow' in self.deca.config.keys() else None
+
+        # the dicts the photometric and VGG terms are reported in (losses or only metrics), bound once
+        if self.deca.vgg_loss is not None:
+            vgg_dict = self._metric_or_loss(losses, metrics, self.deca.config.use_vgg)
+            vggw = float(self.deca.config.vggw)
+        vgg_stream = self._vgg_loss_stream()
+        if self.mode == DecaMode.DETAIL:
+            detailed_photometric_dict = self._metric_or_loss(losses, metrics, self.deca.config.use_detailed_photo)
+
+        if masks is not None and self.deca.vgg_loss is not None:
+            # the masked input image is shared by all the VGG loss terms
+            masked_images = masks[:geom_losses_idxs, ...] * images[:geom_losses_idxs, ...]
+
 
         # this determines the configured batch size that is currently used (training, validation or testing)
         # the reason why this is important is because of potential multi-gpu training and loss functions (such as Barlow Twins)
@@ -1545,12 +1912,13 @@ class DecaModule(LightningModule):
                 #     d = metrics
                 d = self._metric_or_loss(losses, metrics, self.deca.config.use_landmarks)
 
+                lmk_weight = float(self.deca.config.lmk_weight)
                 if self.deca.config.useWlmk:
                     d['landmark'] = \
-                        lossfunc.weighted_landmark_loss(predicted_landmarks[:geom_losses_idxs, ...], lmk[:geom_losses_idxs, ...]) * self.deca.config.lmk_weight
+                        lossfunc.weighted_landmark_loss(predicted_landmarks[:geom_losses_idxs, ...], lmk[:geom_losses_idxs, ...]) * lmk_weight
                 else:
                     d['landmark'] = \
-                        lossfunc.landmark_loss(predicted_landmarks[:geom_losses_idxs, ...], lmk[:geom_losses_idxs, ...]) * self.deca.config.lmk_weight
+                        lossfunc.landmark_loss(predicted_landmarks[:geom_losses_idxs, ...], lmk[:geom_losses_idxs, ...]) * lmk_weight
 
                 d = self._metric_or_loss(losses, metrics, 'use_eye_distance' not in self.deca.config.keys() or
                                          self.deca.config.use_eye_distance)
@@ -1579,54 +1947,46 @@ class DecaModule(LightningModule):
                 #     d = metrics
                 # d['photometric_texture'] = (masks * (predicted_images - images).abs()).mean() * self.deca.config.photow
 
-                photometric = masks[:geom_losses_idxs, ...] * ((predicted_images[:geom_losses_idxs, ...] - images[:geom_losses_idxs, ...]).abs())
-
+                photometric_dict = self._metric_or_loss(losses, metrics, self.deca.config.use_photometric)
                 if 'photometric_normalization' not in self.deca.config.keys() or self.deca.config.photometric_normalization == 'mean':
-                    photometric = photometric.mean()
-                elif self.deca.config.photometric_normalization == 'rel_mask_value':
-                    photometric = photometric * masks[:geom_losses_idxs, ...].mean(dim=tuple(range(1,masks.ndim)), keepdim=True)
-                    photometric = photometric.mean()
-                elif self.deca.config.photometric_normalization == 'neg_rel_mask_value':
-                    mu = 1. - masks[:geom_losses_idxs, ...].mean(dim=tuple(range(1,masks.ndim)), keepdim=True)
-                    photometric = photometric * mu
-                    photometric = photometric.mean()
-                elif self.deca.config.photometric_normalization == 'inv_rel_mask_value':
-                    mu = 1./ masks[:geom_losses_idxs, ...].mean(dim=tuple(range(1,masks.ndim)), keepdim=True)
-                    photometric = photometric * mu
-                    photometric = photometric.mean()
-                elif self.deca.config.photometric_normalization == 'abs_mask_value':
-                    photometric = photometric * masks[:geom_losses_idxs, ...].sum(dim=tuple(range(1,masks.ndim)), keepdim=True)
-                    photometric = photometric.mean()
+                    photometric = _masked_l1(predicted_images[:geom_losses_idxs, ...], images[:geom_losses_idxs, ...],
+                                             masks[:geom_losses_idxs, ...])
                 else:
-                    raise ValueError(f"Invalid photometric loss normalization: '{self.deca.config.photometric_normalization}'")
+                    photometric = masks[:geom_losses_idxs, ...] * ((predicted_images[:geom_losses_idxs, ...] - images[:geom_losses_idxs, ...]).abs())
+                    if self.deca.config.photometric_normalization == 'rel_mask_value':
+                        photometric = photometric * masks[:geom_losses_idxs, ...].mean(dim=tuple(range(1,masks.ndim)), keepdim=True)
+                        photometric = photometric.mean()
+                    elif self.deca.config.photometric_normalization == 'neg_rel_mask_value':
+                        mu = 1. - masks[:geom_losses_idxs, ...].mean(dim=tuple(range(1,masks.ndim)), keepdim=True)
+                        photometric = photometric * mu
+                        photometric = photometric.mean()
+                    elif self.deca.config.photometric_normalization == 'inv_rel_mask_value':
+                        mu = 1./ masks[:geom_losses_idxs, ...].mean(dim=tuple(range(1,masks.ndim)), keepdim=True)
+                        photometric = photometric * mu
+                        photometric = photometric.mean()
+                    elif self.deca.config.photometric_normalization == 'abs_mask_value':
+                        photometric = photometric * masks[:geom_losses_idxs, ...].sum(dim=tuple(range(1,masks.ndim)), keepdim=True)
+                        photometric = photometric.mean()
+                    else:
+                        raise ValueError(f"Invalid photometric loss normalization: '{self.deca.config.photometric_normalization}'")
 
-                self._metric_or_loss(losses, metrics, self.deca.config.use_photometric)['photometric_texture'] = \
-                    photometric * self.deca.config.photow
+                photometric_dict['photometric_texture'] = \
+                    photometric * photow
 
                 if self.deca.vgg_loss is not None:
-                    vggl, _ = self.deca.vgg_loss(
-                        masks[:geom_losses_idxs, ...] * images[:geom_losses_idxs, ...], # masked input image
-                        masks[:geom_losses_idxs, ...] * predicted_images[:geom_losses_idxs, ...], # masked output image
-                    )
-                    self._metric_or_loss(losses, metrics, self.deca.config.use_vgg)['vgg'] = vggl * self.deca.config.vggw
+                    self._compute_vgg_loss(vgg_dict, 'vgg', masked_images, masks[:geom_losses_idxs, ...],
+                                           predicted_images[:geom_losses_idxs, ...], vggw, vgg_stream)
 
                 if self.deca._has_neural_rendering():
                     predicted_translated_image = codedict["predicted_translated_image"]
-                    photometric_translated = (masks[:geom_losses_idxs, ...] * (
-                            predicted_translated_image[:geom_losses_idxs, ...] -
-                            images[:geom_losses_idxs, ...]).abs()).mean() * self.deca.config.photow
-                    if self.deca.config.use_photometric:
-                        losses['photometric_translated_texture'] = photometric_translated
-                    else:
-                        metrics['photometric_translated_texture'] = photometric_translated
+                    photometric_translated = _masked_l1(predicted_translated_image[:geom_losses_idxs, ...],
+                                                        images[:geom_losses_idxs, ...],
+                                                        masks[:geom_losses_idxs, ...]) * photow
+                    photometric_dict['photometric_translated_texture'] = photometric_translated
 
                     if self.deca.vgg_loss is not None:
-                        vggl, _ = self.deca.vgg_loss(
-                            masks[:geom_losses_idxs, ...] * images[:geom_losses_idxs, ...],  # masked input image
-                            masks[:geom_losses_idxs, ...] * predicted_translated_image[:geom_losses_idxs, ...],
-                            # masked output image
-                        )
-                        self._metric_or_loss(losses, metrics, self.deca.config.use_vgg)['vgg_translated'] = vggl * self.deca.config.vggw
+                        self._compute_vgg_loss(vgg_dict, 'vgg_translated', masked_images, masks[:geom_losses_idxs, ...],
+                                               predicted_translated_image[:geom_losses_idxs, ...], vggw, vgg_stream)
 
             else:
                 raise ValueError("Is this line ever reached?")
@@ -1634,11 +1994,12 @@ class DecaModule(LightningModule):
 
             losses = self._compute_id_loss(codedict, batch, training, testing, losses, batch_size=bs, ring_size=rs)
 
-            losses['shape_reg'] = (torch.sum(shapecode ** 2) / 2) * self.deca.config.shape_reg
-            losses['expression_reg'] = (torch.sum(expcode ** 2) / 2) * self.deca.config.exp_reg
-            losses['tex_reg'] = (torch.sum(texcode ** 2) / 2) * self.deca.config.tex_reg
-            losses['light_reg'] = ((torch.mean(lightcode, dim=2)[:, :,
-                                    None] - lightcode) ** 2).mean() * self.deca.config.light_reg
+            # the halving is folded into the (python scalar) weight, saving a kernel launch per term
+            losses['shape_reg'] = torch.sum(shapecode * shapecode) * (0.5 * self.deca.config.shape_reg)
+            losses['expression_reg'] = torch.sum(expcode * expcode) * (0.5 * self.deca.config.exp_reg)
+            losses['tex_reg'] = torch.sum(texcode * texcode) * (0.5 * self.deca.config.tex_reg)
+            # mean squared deviation from the per-channel mean, i.e. the biased variance (single reduction kernel)
+            losses['light_reg'] = lightcode.var(dim=2, unbiased=False).mean() * self.deca.config.light_reg
 
             losses, metrics, codedict = self._compute_emonet_loss_wrapper(codedict, batch, training, testing, losses, metrics,
                                                                  prefix="coarse", image_key="predicted_images",
@@ -1669,41 +2030,27 @@ class DecaModule(LightningModule):
             uv_shading = codedict["uv_shading"]
             uv_vis_mask = codedict["uv_vis_mask"] # uv_mask of what is visible
 
-            photometric_detailed = (masks[:geom_losses_idxs, ...] * (
-                    predicted_detailed_image[:geom_losses_idxs, ...] -
-                    images[:geom_losses_idxs, ...]).abs()).mean() * self.deca.config.photow
+            photometric_detailed = _masked_l1(predicted_detailed_image[:geom_losses_idxs, ...],
+                                              images[:geom_losses_idxs, ...],
+                                              masks[:geom_losses_idxs, ...]) * photow
 
-            if self.deca.config.use_detailed_photo:
-                losses['photometric_detailed_texture'] = photometric_detailed
-            else:
-                metrics['photometric_detailed_texture'] = photometric_detailed
+            detailed_photometric_dict['photometric_detailed_texture'] = photometric_detailed
 
             if self.deca.vgg_loss is not None:
-                vggl, _ = self.deca.vgg_loss(
-                    masks[:geom_losses_idxs, ...] * images[:geom_losses_idxs, ...],  # masked input image
-                    masks[:geom_losses_idxs, ...] * predicted_detailed_image[:geom_losses_idxs, ...],
-                    # masked output image
-                )
-                self._metric_or_loss(losses, metrics, self.deca.config.use_vgg)['vgg_detailed'] = vggl * self.deca.config.vggw
+                self._compute_vgg_loss(vgg_dict, 'vgg_detailed', masked_images, masks[:geom_losses_idxs, ...],
+                                       predicted_detailed_image[:geom_losses_idxs, ...], vggw, vgg_stream)
 
             if self.deca._has_neural_rendering():
                 predicted_detailed_translated_image = codedict["predicted_detailed_translated_image"]
-                photometric_detailed_translated = (masks[:geom_losses_idxs, ...] * (
-                        predicted_detailed_translated_image[:geom_losses_idxs, ...] - images[:geom_losses_idxs,
-                                                                           ...]).abs()).mean() * self.deca.config.photow
-                if self.deca.config.use_detailed_photo:
-                    losses['photometric_translated_detailed_texture'] = photometric_detailed_translated
-                else:
-                    metrics['photometric_translated_detailed_texture'] = photometric_detailed_translated
+                photometric_detailed_translated = _masked_l1(predicted_detailed_translated_image[:geom_losses_idxs, ...],
+                                                             images[:geom_losses_idxs, ...],
+                                                             masks[:geom_losses_idxs, ...]) * photow
+                detailed_photometric_dict['photometric_translated_detailed_texture'] = photometric_detailed_translated
 
                 if self.deca.vgg_loss is not None:
-                    vggl, _ = self.deca.vgg_loss(
-                        masks[:geom_losses_idxs, ...] * images[:geom_losses_idxs, ...],  # masked input image
-                        masks[:geom_losses_idxs, ...] * predicted_detailed_translated_image[:geom_losses_idxs, ...],
-                        # masked output image
-                    )
-                    self._metric_or_loss(losses, metrics, self.deca.config.use_vgg)[
-                        'vgg_detailed_translated'] =  vggl * self.deca.config.vggw
+                    self._compute_vgg_loss(vgg_dict, 'vgg_detailed_translated', masked_images,
+                                           masks[:geom_losses_idxs, ...],
+                                           predicted_detailed_translated_image[:geom_losses_idxs, ...], vggw, vgg_stream)
 
 
             losses, metrics, codedict = self._compute_emonet_loss_wrapper(codedict, batch, training, testing, losses, metrics,
@@ -1763,57 +2110,60 @@ class DecaModule(LightningModule):
                                           with_grad=self.deca.config.au_loss.use_as_loss and self.deca._has_neural_rendering())
 
             for pi in range(3):  # self.deca.face_attr_mask.shape[0]):
-                if self.deca.config.sfsw[pi] != 0:
+                patch_weight = float(self.deca.config.sfsw[pi])
+                if patch_weight != 0:
+                    mrf_weight = patch_weight * self.deca.config.mrfwr if self.deca.perceptual_loss is not None else None
                     # if pi==0:
                     new_size = 256
                     # else:
                     #     new_size = 128
                     # if self.deca.config.uv_size != 256:
                     #     new_size = 128
-                    uv_texture_patch = F.interpolate(
-                        uv_texture[:geom_losses_idxs, :, self.deca.face_attr_mask[pi][2]:self.deca.face_attr_mask[pi][3],
-                        self.deca.face_attr_mask[pi][0]:self.deca.face_attr_mask[pi][1]],
-                        [new_size, new_size], mode='bilinear')
-                    uv_texture_gt_patch = F.interpolate(
-                        uv_texture_gt[:geom_losses_idxs, :, self.deca.face_attr_mask[pi][2]:self.deca.face_attr_mask[pi][3],
-                        self.deca.face_attr_mask[pi][0]:self.deca.face_attr_mask[pi][1]], [new_size, new_size],
-                        mode='bilinear')
-                    uv_vis_mask_patch = F.interpolate(
-                        uv_vis_mask[:geom_losses_idxs, :, self.deca.face_attr_mask[pi][2]:self.deca.face_attr_mask[pi][3],
-                        self.deca.face_attr_mask[pi][0]:self.deca.face_attr_mask[pi][1]],
+                    x0, x1, y0, y1 = (int(c) for c in self.deca.face_attr_mask[pi])
+                    # the texture, GT texture and visibility mask crops are resized in one call (stacked along channels,
+                    # bilinear interpolation treats channels independently)
+                    patches = F.interpolate(
+                        torch.cat([uv_texture[:geom_losses_idxs, :, y0:y1, x0:x1],
+                                   uv_texture_gt[:geom_losses_idxs, :, y0:y1, x0:x1],
+                                   uv_vis_mask[:geom_losses_idxs, :, y0:y1, x0:x1]], dim=1),
                         [new_size, new_size], mode='bilinear')
-
-                    detail_l1 = (uv_texture_patch * uv_vis_mask_patch - uv_texture_gt_patch * uv_vis_mask_patch).abs().mean() * \
-                                                        self.deca.config.sfsw[pi]
-                    if self.deca.config.use_detail_l1 and not self.deca._has_neural_rendering():
+                    uv_texture_patch, uv_texture_gt_patch, uv_vis_mask_patch = torch.split(
+                        patches, [uv_texture.shape[1], uv_texture_gt.shape[1], uv_vis_mask.shape[1]], dim=1)
+
+                    use_detail_l1 = self.deca.config.use_detail_l1 and not self.deca._has_neural_rendering()
+                    use_detail_mrf = self.deca.config.use_detail_mrf and not self.deca._has_neural_rendering()
+                    # the visible parts of the patches are shared by the L1 and MRF terms
+                    with torch.set_grad_enabled(torch.is_grad_enabled() and (use_detail_l1 or use_detail_mrf)):
+                        uv_texture_patch_vis = uv_texture_patch * uv_vis_mask_patch
+                    uv_texture_gt_patch_vis = uv_texture_gt_patch * uv_vis_mask_patch
+                    # the metric-only variant does not need autograd bookkeeping
+                    with torch.set_grad_enabled(torch.is_grad_enabled() and use_detail_l1):
+                        detail_l1 = (uv_texture_patch_vis - uv_texture_gt_patch_vis).abs().mean() * patch_weight
+                    if use_detail_l1:
                         losses['detail_l1_{}'.format(pi)] = detail_l1
                     else:
                         metrics['detail_l1_{}'.format(pi)] = detail_l1
 
-                    if self.deca.config.use_detail_mrf and not self.deca._has_neural_rendering():
-                        mrf = self.deca.perceptual_loss(uv_texture_patch * uv_vis_mask_patch,
-                                                        uv_texture_gt_patch * uv_vis_mask_patch) * \
-                                                        self.deca.config.sfsw[pi] * self.deca.config.mrfwr
+                    if use_detail_mrf:
+                        mrf = self.deca.perceptual_loss(uv_texture_patch_vis, uv_texture_gt_patch_vis) * mrf_weight
                         losses['detail_mrf_{}'.format(pi)] = mrf
                     else:
-                        with torch.no_grad():
-                            mrf = self.deca.perceptual_loss(uv_texture_patch * uv_vis_mask_patch,
-                                                            uv_texture_gt_patch * uv_vis_mask_patch) * \
-                                  self.deca.config.sfsw[pi] * self.deca.config.mrfwr
+                        with torch.no_grad(), self._metric_autocast(False):
+                            mrf = self.deca.perceptual_loss(uv_texture_patch_vis, uv_texture_gt_patch_vis) * mrf_weight
                             metrics['detail_mrf_{}'.format(pi)] = mrf
 
                     if self.deca._has_neural_rendering():
                         # raise NotImplementedError("Gotta implement the texture extraction first.")
                         translated_uv_texture = codedict["translated_uv_texture"]
                         translated_uv_texture_patch = F.interpolate(
-                            translated_uv_texture[:geom_losses_idxs, :,
-                            self.deca.face_attr_mask[pi][2]:self.deca.face_attr_mask[pi][3],
-                            self.deca.face_attr_mask[pi][0]:self.deca.face_attr_mask[pi][1]],
+                            translated_uv_texture[:geom_losses_idxs, :, y0:y1, x0:x1],
                             [new_size, new_size], mode='bilinear')
 
-                        translated_detail_l1 = (translated_uv_texture_patch * uv_vis_mask_patch
-                                     - uv_texture_gt_patch * uv_vis_mask_patch).abs().mean() * \
-                                    self.deca.config.sfsw[pi]
+                        with torch.set_grad_enabled(torch.is_grad_enabled() and
+                                                    (self.deca.config.use_detail_l1 or self.deca.config.use_detail_mrf)):
+                            translated_uv_texture_patch_vis = translated_uv_texture_patch * uv_vis_mask_patch
+                        with torch.set_grad_enabled(torch.is_grad_enabled() and self.deca.config.use_detail_l1):
+                            translated_detail_l1 = (translated_uv_texture_patch_vis - uv_texture_gt_patch_vis).abs().mean() * patch_weight
 
                         if self.deca.config.use_detail_l1:
                             losses['detail_translated_l1_{}'.format(pi)] = translated_detail_l1
@@ -1821,15 +2171,13 @@ class DecaModule(LightningModule):
                             metrics['detail_translated_l1_{}'.format(pi)] = translated_detail_l1
 
                         if self.deca.config.use_detail_mrf:
-                            translated_mrf = self.deca.perceptual_loss(translated_uv_texture_patch * uv_vis_mask_patch,
-                                                            uv_texture_gt_patch * uv_vis_mask_patch) * \
-                                  self.deca.config.sfsw[pi] * self.deca.config.mrfwr
+                            translated_mrf = self.deca.perceptual_loss(translated_uv_texture_patch_vis,
+                                                                       uv_texture_gt_patch_vis) * mrf_weight
                             losses['detail_translated_mrf_{}'.format(pi)] = translated_mrf
                         else:
-                            with torch.no_grad():
-                                mrf = self.deca.perceptual_loss(translated_uv_texture_patch * uv_vis_mask_patch,
-                                                                uv_texture_gt_patch * uv_vis_mask_patch) * \
-                                      self.deca.config.sfsw[pi] * self.deca.config.mrfwr
+                            with torch.no_grad(), self._metric_autocast(False):
+                                mrf = self.deca.perceptual_loss(translated_uv_texture_patch_vis,
+                                                                uv_texture_gt_patch_vis) * mrf_weight
                                 metrics['detail_translated_mrf_{}'.format(pi)] = mrf
                 # Old piece of debug code. Good to delete.
                 # if pi == 2:
@@ -1840,7 +2188,8 @@ class DecaModule(LightningModule):
             losses['z_reg'] = torch.mean(uv_z.abs()) * self.deca.config.zregw
             losses['z_diff'] = lossfunc.shading_smooth_loss(uv_shading) * self.deca.config.zdiffw
             nonvis_mask = (1 - util.binary_erosion(uv_vis_mask))
-            losses['z_sym'] = (nonvis_mask * (uv_z - torch.flip(uv_z, [-1]).detach()).abs()).sum() * self.deca.config.zsymw
+            # the mirrored displacement is a constant target, flipped after detaching (no autograd node)
+            losses['z_sym'] = (nonvis_mask * (uv_z - uv_z.detach().flip(-1)).abs()).sum() * self.deca.config.zsymw
 
         if self.emotion_mlp is not None:# and not testing:
             mlp_losses, mlp_metrics = self.emotion_mlp.compute_loss(
@@ -1862,6 +2211,12 @@ class DecaModule(LightningModule):
         #     uv_texture_patch_ = None
         #     uv_vis_mask_patch_ = None
 
+        if vgg_stream is not None:
+            # the VGG terms issued on the side stream have to be finished before the losses are used
+            torch.cuda.current_stream().wait_stream(vgg_stream)
+
+        # do not keep the reference images alive beyond the loss computation
+        self._reference_emotion = None
         return losses, metrics
 
     def compute_loss(self, values, batch, training=True, testing=False) -> (dict, dict):
@@ -1872,18 +2227,22 @@ class DecaModule(LightningModule):
         """
         losses, metrics = self._compute_loss(values, batch, training=training, testing=testing)
 
-        all_loss = 0.
-        losses_key = losses.keys()
-        for key in losses_key:
-            all_loss = all_loss + losses[key]
-        # losses['all_loss'] = all_loss
-        losses = {'loss_' + key: value for key, value in losses.items()} # add prefix loss for better logging
-        losses['loss'] = all_loss
+        # a single pass over the losses adds the prefix for better logging and collects the terms of the total loss
+        losses_and_metrics = {}
+        loss_terms = []
+        for key, value in losses.items():
+            losses_and_metrics['loss_' + key] = value
+            loss_terms += [value.reshape(()).float()]
+        # one reduction instead of a chain of additions (the terms may come in different precisions under AMP)
+        if len(loss_terms) > 0:
+            losses_and_metrics['loss'] = torch.stack(loss_terms).sum()
+        else:
+            losses_and_metrics['loss'] = torch.zeros((), device=self.device)
 
         # add metrics that do not effect the loss function (if any)
-        for key in metrics.keys():
-            losses['metric_' + key] = metrics[key]
-        return losses
+        for key, value in metrics.items():
+            losses_and_metrics['metric_' + key] = value
+        return losses_and_metrics
 
     def _val_to_be_logged(self, d):
         if not hasattr(self, 'val_dict_list'):
@@ -1895,6 +2254,17 @@ class DecaModule(LightningModule):
             self.train_dict_list = []
         self.train_dict_list += [d]
 
+    @property
+    def _wandb_logging(self):
+        """
+        Whether the current logger is a WandbLogger. Resolved from the current logger (which may also come from a
+        trainer assigned by a wrapping module, such as EmoDECA) and cached as long as the logger stays the same.
+        """
+        logger = self.logger
+        if self._wandb_logging_cache is None or self._wandb_logging_cache[0] != id(logger):
+            self._wandb_logging_cache = (id(logger), isinstance(logger, WandbLogger))
+        return self._wandb_logging_cache[1]
+
     def validation_step(self, batch, batch_idx, dataloader_idx=None):
         """
         Training step override of pytorch lightning module. It makes the encoding, decoding passes, computes the loss and logs the losses/visualizations. 
@@ -1920,24 +2290,22 @@ class DecaModule(LightningModule):
 
         # losses_and_metrics_to_log = {prefix + dataloader_str +'_val_' + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
         # losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach() for key, value in losses_and_metrics.items()}
-        losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach().cpu().item() for key, value in losses_and_metrics.items()}
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'epoch'] = self.current_epoch
-        # losses_and_metrics_to_log[prefix + '_' + stage_str + 'epoch'] = torch.tensor(self.current_epoch, device=self.device)
+        full_prefix = f'{prefix}_{stage_str}'
+        # the bookkeeping values are rank-local and are logged without synchronization across processes
+        local_to_log = {}
+        losses_and_metrics_to_log = {f'{full_prefix}{key}': value for key, value in _scalars_to_floats(losses_and_metrics).items()}
         # log val_loss also without any prefix for a model checkpoint to track it
-        losses_and_metrics_to_log[stage_str + 'loss'] = losses_and_metrics_to_log[prefix + '_' + stage_str + 'loss']
-
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'step'] = self.global_step
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'batch_idx'] = batch_idx
-        losses_and_metrics_to_log[stage_str + 'step'] = self.global_step
-        losses_and_metrics_to_log[stage_str + 'batch_idx'] = batch_idx
+        losses_and_metrics_to_log[stage_str + 'loss'] = losses_and_metrics_to_log[full_prefix + 'loss']
 
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'mem_usage'] = self.process.memory_info().rss
-        losses_and_metrics_to_log[stage_str + 'mem_usage'] = self.process.memory_info().rss
+        mem_usage = self._memory_usage()
+        local_to_log[full_prefix + 'mem_usage'] = mem_usage
+        local_to_log[stage_str + 'mem_usage'] = mem_usage
         # self._val_to_be_logged(losses_and_metrics_to_log)
 
 
         if self.logger is not None:
             self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch # recommended
+            self.log_dict(local_to_log, on_step=False, on_epoch=True, sync_dist=False)
 
         if self.trainer.is_global_zero:
             if self.deca.config.val_vis_frequency > 0:
@@ -1950,14 +2318,17 @@ class DecaModule(LightningModule):
                     vis_dict = self._create_visualizations_to_log(stage_str[:-1], visualizations, values, batch_idx, indices=0, dataloader_idx=dataloader_idx)
                     # image = Image(grid_image, caption="full visualization")
                     # vis_dict[prefix + '_val_' + "visualization"] = image
-                    if isinstance(self.logger, WandbLogger):
+                    if self._wandb_logging:
                         self.logger.log_metrics(vis_dict)
 
         return None
 
     def _get_logging_prefix(self):
-        prefix = self.stage_name + str(self.mode.name).lower()
-        return prefix
+        # cached, the stage name and mode only change on reconfiguration
+        key = (self.stage_name, self.mode)
+        if getattr(self, '_logging_prefix_cache', (None, None))[0] != key:
+            self._logging_prefix_cache = (key, self.stage_name + str(self.mode.name).lower())
+        return self._logging_prefix_cache[1]
 
     def test_step(self, batch, batch_idx, dataloader_idx=None):
         """
@@ -1975,6 +2346,7 @@ class DecaModule(LightningModule):
         # else:
         dataloader_str = ''
         stage_str = dataloader_str + 'test_'
+        full_prefix = f'{prefix}_{stage_str}'
 
         with torch.no_grad():
             training = False
@@ -1984,7 +2356,7 @@ class DecaModule(LightningModule):
             if 'mask' in batch.keys():
                 losses_and_metrics = self.compute_loss(values, batch, training=False, testing=testing)
                 # losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
-                losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach().cpu().item() for key, value in losses_and_metrics.items()}
+                losses_and_metrics_to_log = {f'{full_prefix}{key}': value for key, value in _scalars_to_floats(losses_and_metrics).items()}
             else:
                 losses_and_metric = None
 
@@ -1995,40 +2367,41 @@ class DecaModule(LightningModule):
         # losses_and_metrics_to_log[stage_str + 'epoch'] = torch.tensor(self.current_epoch, device=self.device)
         # losses_and_metrics_to_log[stage_str + 'step'] = torch.tensor(self.global_step, device=self.device)
         # losses_and_metrics_to_log[stage_str + 'batch_idx'] = torch.tensor(batch_idx, device=self.device)
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'epoch'] = self.current_epoch
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'step'] = self.global_step
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'batch_idx'] = batch_idx
-        losses_and_metrics_to_log[prefix + '_' + stage_str + 'mem_usage'] = self.process.memory_info().rss
-        losses_and_metrics_to_log[stage_str + 'epoch'] = self.current_epoch
-        losses_and_metrics_to_log[stage_str + 'step'] = self.global_step
-        losses_and_metrics_to_log[stage_str + 'batch_idx'] = batch_idx
-        losses_and_metrics_to_log[stage_str + 'mem_usage'] = self.process.memory_info().rss
+        mem_usage = self._memory_usage()
+        # the bookkeeping values are rank-local and are logged without synchronization across processes
+        local_to_log = {}
+        local_to_log[full_prefix + 'mem_usage'] = mem_usage
+        local_to_log[stage_str + 'mem_usage'] = mem_usage
 
         if self.logger is not None:
             # self.logger.log_metrics(losses_and_metrics_to_log)
             self.log_dict(losses_and_metrics_to_log, sync_dist=True, on_step=False, on_epoch=True)
+            self.log_dict(local_to_log, sync_dist=False, on_step=False, on_epoch=True)
 
         # if self.global_step % 200 == 0:
         uv_detail_normals = None
         if 'uv_detail_normals' in values.keys():
             uv_detail_normals = values['uv_detail_normals']
 
-        if self.deca.config.test_vis_frequency > 0:
-            # Log visualizations every once in a while
+        if self.deca.config.test_vis_frequency > 0 and self.trainer.is_global_zero:
+            # Log visualizations every once in a while (only rank zero writes to the logger, the other ranks would
+            # render and convert the images for nothing)
             if batch_idx % self.deca.config.test_vis_frequency == 0:
-                # if self.trainer.is_global_zero:
                 visualizations, grid_image = self._visualization_checkpoint(values['verts'], values['trans_verts'], values['ops'],
                                                uv_detail_normals, values, self.global_step, stage_str[:-1], prefix)
                 visdict = self._create_visualizations_to_log(stage_str[:-1], visualizations, values, batch_idx, indices=0, dataloader_idx=dataloader_idx)
                 self.logger.log_metrics(visdict)
         return None
 
-    @property
-    def process(self):
-        if not hasattr(self,"process_"):
-            import psutil
-            self.process_ = psutil.Process(os.getpid())
-        return self.process_
+    def _memory_usage(self, max_age=1.0):
+        """
+        Resident memory of the process for logging. Querying it reads /proc, so the value is reused for up to
+        max_age seconds.
+        """
+        now = time.monotonic()
+        if not hasattr(self, "_rss_") or now - self._rss_[0] >= max_age:
+            self._rss_ = (now, _current_process().memory_info().rss)
+        return self._rss_[1]
 
 
     def training_step(self, batch, batch_idx, *args, **kwargs): #, debug=True):
@@ -2048,27 +2421,31 @@ class DecaModule(LightningModule):
 
         # prefix = str(self.mode.name).lower()
         prefix = self._get_logging_prefix()
-        # losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
-        # losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach() for key, value in losses_and_metrics.items()}
-        losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach().cpu().item() for key, value in losses_and_metrics.items()}
-        # losses_and_metrics_to_log[prefix + '_train_' + 'epoch'] = torch.tensor(self.current_epoch, device=self.device)
-        losses_and_metrics_to_log[prefix + '_train_' + 'epoch'] = self.current_epoch
-        losses_and_metrics_to_log[prefix + '_train_' + 'step'] = self.global_step
-        losses_and_metrics_to_log[prefix + '_train_' + 'batch_idx'] = batch_idx
-        losses_and_metrics_to_log[prefix + '_' + "train_" + 'mem_usage'] = self.process.memory_info().rss
-
-        # losses_and_metrics_to_log['train_' + 'epoch'] = torch.tensor(self.current_epoch, device=self.device)
-        losses_and_metrics_to_log['train_' + 'epoch'] = self.current_epoch
-        losses_and_metrics_to_log['train_' + 'step'] = self.global_step
-        losses_and_metrics_to_log['train_' + 'batch_idx'] = batch_idx
-
-        losses_and_metrics_to_log["train_" + 'mem_usage'] = self.process.memory_info().rss
-
-        # log loss also without any prefix for a model checkpoint to track it
-        losses_and_metrics_to_log['loss'] = losses_and_metrics_to_log[prefix + '_train_loss']
 
+        # the full set of losses and metrics is only built and logged every log_every_n_steps steps (the epoch averages
+        # are then computed from these steps only), the loss itself is logged on every step for the model checkpoint
+        log_every_n_steps = self.learning_params.log_every_n_steps \
+            if 'log_every_n_steps' in self.learning_params.keys() else 50
+        if self.global_step % log_every_n_steps == 0:
+            # losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
+            # losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach() for key, value in losses_and_metrics.items()}
+            full_prefix = f'{prefix}_train_'
+            # the bookkeeping values are rank-local and are logged without synchronization across processes
+            local_to_log = {}
+            losses_and_metrics_to_log = {f'{full_prefix}{key}': value for key, value in _scalars_to_floats(losses_and_metrics).items()}
+            mem_usage = self._memory_usage()
+            local_to_log[full_prefix + 'mem_usage'] = mem_usage
+            local_to_log["train_" + 'mem_usage'] = mem_usage
+
+            if self.logger is not None:
+                self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch, # recommended
+                self.log_dict(local_to_log, on_step=False, on_epoch=True, sync_dist=False)
+
+        # log loss also without any prefix for a model checkpoint to track it (as a tensor, Lightning accumulates it on
+        # the device and no host sync is needed on the steps that do not log the full dict)
+        loss = losses_and_metrics['loss']
         if self.logger is not None:
-            self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch, # recommended
+            self.log('loss', loss.detach(), on_step=False, on_epoch=True, sync_dist=True)
 
         if self.deca.config.train_vis_frequency > 0:
             if self.global_step % self.deca.config.train_vis_frequency == 0:
@@ -2077,7 +2454,7 @@ class DecaModule(LightningModule):
                                                    uv_detail_normals, values, batch_idx, "train", prefix)
                     visdict = self._create_visualizations_to_log('train', visualizations, values, batch_idx, indices=0)
 
-                    if isinstance(self.logger, WandbLogger):
+                    if self._wandb_logging:
                         self.logger.log_metrics(visdict)#, step=self.global_step)
                         # self.log_dict(visdict, sync_dist=True)
 
@@ -2085,7 +2462,7 @@ class DecaModule(LightningModule):
         # self.log_dict(losses_and_metrics_to_log, on_step=True, on_epoch=False) # log per step
         # self.log_dict(losses_and_metrics_to_log, on_step=True, on_epoch=True) # log per both
         # return losses_and_metrics
-        return losses_and_metrics['loss']
+        return loss
 
 
     ### STEP ENDS ARE PROBABLY NOT NECESSARY BUT KEEP AN EYE ON THEM IF MULI-GPU TRAINING DOESN'T WORK
@@ -2098,30 +2475,23 @@ class DecaModule(LightningModule):
     # def _step_end(self, batch_parts):
     #     # gpu_0_prediction = batch_parts.pred[0]['pred']
     #     # gpu_1_prediction = batch_parts.pred[1]['pred']
-    #     N = len(batch_parts)
-    #     loss_dict = {}
-    #     for key in batch_parts[0]:
-    #         for i in range(N):
-    #             if key not in loss_dict.keys():
-    #                 loss_dict[key] = batch_parts[i]
-    #             else:
-    #                 loss_dict[key] = batch_parts[i]
-    #         loss_dict[key] = loss_dict[key] / N
-    #     return loss_dict
+    #     # average each value over the parts with a single reduction per key
+    #     return {key: torch.stack([part[key] for part in batch_parts]).mean(dim=0) for key in batch_parts[0]}
 
 
     def vae_2_str(self, valence=None, arousal=None, affnet_expr=None, expr7=None, prefix=""):
         caption = ""
         if len(prefix) > 0:
             prefix += "_"
-        if valence is not None and not np.isnan(valence).any():
-            caption += prefix + "valence= %.03f\n" % valence
-        if arousal is not None and not np.isnan(arousal).any():
-            caption += prefix + "arousal= %.03f\n" % arousal
-        if affnet_expr is not None and not np.isnan(affnet_expr).any():
-            caption += prefix + "expression= %s \n" % AffectNetExpressions(affnet_expr).name
-        if expr7 is not None and not np.isnan(expr7).any():
-            caption += prefix +"expression= %s \n" % Expression7(expr7).name
+        # the values are scalars (python numbers or single element arrays)
+        if valence is not None and not math.isnan(float(valence)):
+            caption += f"{prefix}valence= {float(valence):.3f}\n"
+        if arousal is not None and not math.isnan(float(arousal)):
+            caption += f"{prefix}arousal= {float(arousal):.3f}\n"
+        if affnet_expr is not None and not math.isnan(float(affnet_expr)):
+            caption += f"{prefix}expression= {AffectNetExpressions(affnet_expr).name} \n"
+        if expr7 is not None and not math.isnan(float(expr7)):
+            caption += f"{prefix}expression= {Expression7(expr7).name} \n"
         return caption
 
 
@@ -2129,23 +2499,49 @@ class DecaModule(LightningModule):
                                       dataloader_idx=None, output_dir=None):
         mode_ = str(self.mode.name).lower()
         prefix = self._get_logging_prefix()
+        # the keys used for the captions are the same for every visualized image
+        value_keys = set(values.keys())
+        k_valence_input, k_arousal_input, k_expression_input = \
+            f"{mode_}_valence_input", f"{mode_}_arousal_input", f"{mode_}_expression_input"
+        k_valence_gt, k_arousal_gt, k_expression_gt = f"{mode_}valence_gt", f"{mode_}arousal_gt", f"{mode_}_expression_gt"
+        k_valence_output, k_arousal_output, k_expression_output = \
+            f"{mode_}_valence_output", f"{mode_}_arousal_output", f"{mode_}_expression_output"
+        k_translated_valence_output, k_translated_arousal_output, k_translated_expression_output = \
+            f"{mode_}_translated_valence_output", f"{mode_}_translated_arousal_output", \
+            f"{mode_}_translated_expression_output"
+        k_output_images, k_output_translated_images = f"output_images_{mode_}", f"output_translated_images_{mode_}"
 
         output_dir = output_dir or self.inout_params.full_run_dir
 
+        # the emotion values shown in the captions are moved to the host once per call (instead of once per image)
+        caption_values = {}
+        if self.emonet_loss is not None:
+            for k in [k_valence_input, k_arousal_input, k_valence_gt, k_arousal_gt, k_valence_output, k_arousal_output,
+                      k_translated_valence_output, k_translated_arousal_output, "emo_mlp_valence", "emo_mlp_arousal"]:
+                if k in value_keys:
+                    caption_values[k] = values[k].detach().reshape(values[k].shape[0], -1)[:, 0].tolist()
+            for k in [k_expression_input, k_expression_output, k_translated_expression_output,
+                      "emo_mlp_expr_classification"]:
+                if k in value_keys:
+                    caption_values[k] = values[k].detach().reshape(values[k].shape[0], -1).argmax(dim=1).tolist()
+
         log_dict = {}
+        if isinstance(indices, int):
+            indices = [indices,]
+        if indices is None or (isinstance(indices, str) and indices == 'all'):
+            visdict_np = _visualizations_to_np(visdict)
+        else:
+            # only the requested images are selected (on the device) and moved to the host
+            visdict_np = _visualizations_to_np({key: value[list(indices)] for key, value in visdict.items()})
         for key in visdict.keys():
-            images = _torch_image2np(visdict[key])
-            if images.dtype == np.float32 or images.dtype == np.float64 or images.dtype == np.float16:
-                images = np.clip(images, 0, 1)
+            images = visdict_np[key]
             if indices is None:
                 indices = np.arange(images.shape[0])
-            if isinstance(indices, int):
-                indices = [indices,]
             if isinstance(indices, str) and indices == 'all':
                 image = np.concatenate([images[i] for i in range(images.shape[0])], axis=1)
                 savepath = Path(f'{output_dir}/{prefix}_{stage}/{key}/{self.current_epoch:04d}_{step:04d}_all.png')
                 # im2log = Image(image, caption=key)
-                if isinstance(self.logger, WandbLogger):
+                if self._wandb_logging:
                     im2log = _log_wandb_image(savepath, image)
                 else:
                     im2log = _log_array_image(savepath, image)
@@ -2154,54 +2550,55 @@ class DecaModule(LightningModule):
                     name += "/dataloader_idx_" + str(dataloader_idx)
                 log_dict[name] = im2log
             else:
-                for i in indices:
+                # i is the index in the batch, j the index of the image in the converted images
+                for j, i in enumerate(indices):
                     caption = key + f" batch_index={step}\n"
                     caption += key + f" index_in_batch={i}\n"
                     if self.emonet_loss is not None:
                         if key == 'inputs':
-                            if mode_ + "_valence_input" in values.keys():
+                            if k_valence_input in value_keys:
                                 caption += self.vae_2_str(
-                                    values[mode_ + "_valence_input"][i].detach().cpu().item(),
-                                    values[mode_ + "_arousal_input"][i].detach().cpu().item(),
-                                    np.argmax(values[mode_ + "_expression_input"][i].detach().cpu().numpy()),
+                                    caption_values[k_valence_input][i],
+                                    caption_values[k_arousal_input][i],
+                                    caption_values[k_expression_input][i],
                                     prefix="emonet") + "\n"
-                            if 'va' in values.keys() and mode_ + "valence_gt" in values.keys():
+                            if 'va' in value_keys and k_valence_gt in value_keys:
                                 # caption += self.vae_2_str(
                                 #     values[mode_ + "_valence_gt"][i].detach().cpu().item(),
                                 #     values[mode_ + "_arousal_gt"][i].detach().cpu().item(),
                                 caption += self.vae_2_str(
-                                    values[mode_ + "valence_gt"][i].detach().cpu().item(),
-                                    values[mode_ + "arousal_gt"][i].detach().cpu().item(),
+                                    caption_values[k_valence_gt][i],
+                                    caption_values[k_arousal_gt][i],
                                     prefix="gt") + "\n"
-                            if 'expr7' in values.keys() and mode_ + "_expression_gt" in values.keys():
+                            if 'expr7' in value_keys and k_expression_gt in value_keys:
                                 caption += "\n" + self.vae_2_str(
-                                    expr7=values[mode_ + "_expression_gt"][i].detach().cpu().numpy(),
+                                    expr7=values[k_expression_gt][i].detach().cpu().numpy(),
                                     prefix="gt") + "\n"
-                            if 'affectnetexp' in values.keys() and mode_ + "_expression_gt" in values.keys():
+                            if 'affectnetexp' in value_keys and k_expression_gt in value_keys:
                                 caption += "\n" + self.vae_2_str(
-                                    affnet_expr=values[mode_ + "_expression_gt"][i].detach().cpu().numpy(),
+                                    affnet_expr=values[k_expression_gt][i].detach().cpu().numpy(),
                                     prefix="gt") + "\n"
                         elif 'geometry_detail' in key:
-                            if "emo_mlp_valence" in values.keys():
+                            if "emo_mlp_valence" in value_keys:
                                 caption += self.vae_2_str(
-                                    values["emo_mlp_valence"][i].detach().cpu().item(),
-                                    values["emo_mlp_arousal"][i].detach().cpu().item(),
+                                    caption_values["emo_mlp_valence"][i],
+                                    caption_values["emo_mlp_arousal"][i],
                                     prefix="mlp")
-                            if 'emo_mlp_expr_classification' in values.keys():
+                            if 'emo_mlp_expr_classification' in value_keys:
                                 caption += "\n" + self.vae_2_str(
-                                    affnet_expr=values["emo_mlp_expr_classification"][i].detach().cpu().argmax().numpy(),
+                                    affnet_expr=caption_values["emo_mlp_expr_classification"][i],
                                     prefix="mlp") + "\n"
-                        elif key == 'output_images_' + mode_:
-                            if mode_ + "_valence_output" in values.keys():
-                                caption += self.vae_2_str(values[mode_ + "_valence_output"][i].detach().cpu().item(),
-                                                                 values[mode_ + "_arousal_output"][i].detach().cpu().item(),
-                                                                 np.argmax(values[mode_ + "_expression_output"][i].detach().cpu().numpy())) + "\n"
+                        elif key == k_output_images:
+                            if k_valence_output in value_keys:
+                                caption += self.vae_2_str(caption_values[k_valence_output][i],
+                                                                 caption_values[k_arousal_output][i],
+                                                                 caption_values[k_expression_output][i]) + "\n"
 
-                        elif key == 'output_translated_images_' + mode_:
-                            if mode_ + "_translated_valence_output" in values.keys():
-                                caption += self.vae_2_str(values[mode_ + "_translated_valence_output"][i].detach().cpu().item(),
-                                                                 values[mode_ + "_translated_arousal_output"][i].detach().cpu().item(),
-                                                                 np.argmax(values[mode_ + "_translated_expression_output"][i].detach().cpu().numpy())) + "\n"
+                        elif key == k_output_translated_images:
+                            if k_translated_valence_output in value_keys:
+                                caption += self.vae_2_str(caption_values[k_translated_valence_output][i],
+                                                                 caption_values[k_translated_arousal_output][i],
+                                                                 caption_values[k_translated_expression_output][i]) + "\n"
 
 
                         # elif key == 'output_images_detail':
@@ -2210,9 +2607,9 @@ class DecaModule(LightningModule):
                         #                                  np.argmax(values["detail_output_expression"][
                         #                                                i].detach().cpu().numpy()))
                     savepath = Path(f'{output_dir}/{prefix}_{stage}/{key}/{self.current_epoch:04d}_{step:04d}_{i:02d}.png')
-                    image = images[i]
+                    image = images[j]
                     # im2log = Image(image, caption=caption)
-                    if isinstance(self.logger, WandbLogger):
+                    if self._wandb_logging:
                         im2log = _log_wandb_image(savepath, image, caption)
                     elif self.logger is not None:
                         im2log = _log_array_image(savepath, image, caption)
@@ -2226,69 +2623,71 @@ class DecaModule(LightningModule):
 
     def _visualization_checkpoint(self, verts, trans_verts, ops, uv_detail_normals, additional, batch_idx, stage, prefix,
                                   save=False):
-        batch_size = verts.shape[0]
-        visind = np.arange(batch_size)
-        shape_images = self.deca.render.render_shape(verts, trans_verts)
         if uv_detail_normals is not None:
             detail_normal_images = F.grid_sample(uv_detail_normals.detach(), ops['grid'].detach(),
                                                  align_corners=False)
-            shape_detail_images = self.deca.render.render_shape(verts, trans_verts,
-                                                           detail_normal_images=detail_normal_images)
         else:
-            shape_detail_images = None
-
+            detail_normal_images = None
+        # the coarse and the detail geometry are shaded from a single rasterization of the mesh
+        shape_images, shape_detail_images = self.deca.render.render_shape(verts, trans_verts,
+                                                                          detail_normal_images=detail_normal_images,
+                                                                          return_coarse=True)
+
+        additional_keys = frozenset(additional.keys())
+        # the whole batch is visualized, so the tensors are put into visdict as they are (without copying)
         visdict = {}
-        if 'images' in additional.keys():
-            visdict['inputs'] = additional['images'][visind]
+        if 'images' in additional_keys:
+            visdict['inputs'] = additional['images']
 
-        if 'images' in additional.keys() and 'lmk' in additional.keys():
-            visdict['landmarks_gt'] = util.tensor_vis_landmarks(additional['images'][visind], additional['lmk'][visind])
+        if 'images' in additional_keys and 'lmk' in additional_keys:
+            visdict['landmarks_gt'] = util.tensor_vis_landmarks(additional['images'], additional['lmk'])
 
-        if 'images' in additional.keys() and 'predicted_landmarks' in additional.keys():
-            visdict['landmarks_predicted'] = util.tensor_vis_landmarks(additional['images'][visind],
-                                                                     additional['predicted_landmarks'][visind])
+        if 'images' in additional_keys and 'predicted_landmarks' in additional_keys:
+            visdict['landmarks_predicted'] = util.tensor_vis_landmarks(additional['images'],
+                                                                     additional['predicted_landmarks'])
 
-        if 'predicted_images' in additional.keys():
-            visdict['output_images_coarse'] = additional['predicted_images'][visind]
+        if 'predicted_images' in additional_keys:
+            visdict['output_images_coarse'] = additional['predicted_images']
 
-        if 'predicted_translated_image' in additional.keys() and additional['predicted_translated_image'] is not None:
-            visdict['output_translated_images_coarse'] = additional['predicted_translated_image'][visind]
+        if 'predicted_translated_image' in additional_keys and additional['predicted_translated_image'] is not None:
+            visdict['output_translated_images_coarse'] = additional['predicted_translated_image']
 
-        visdict['geometry_coarse'] = shape_images[visind]
+        visdict['geometry_coarse'] = shape_images
         if shape_detail_images is not None:
-            visdict['geometry_detail'] = shape_detail_images[visind]
+            visdict['geometry_detail'] = shape_detail_images
 
-        if 'albedo_images' in additional.keys():
-            visdict['albedo_images'] = additional['albedo_images'][visind]
+        if 'albedo_images' in additional_keys:
+            visdict['albedo_images'] = additional['albedo_images']
 
-        if 'masks' in additional.keys():
-            visdict['mask'] = additional['masks'].repeat(1, 3, 1, 1)[visind]
-        if 'albedo' in additional.keys():
-            visdict['albedo'] = additional['albedo'][visind]
+        if 'masks' in additional_keys:
+            visdict['mask'] = additional['masks'].expand(-1, 3, -1, -1)
+        if 'albedo' in additional_keys:
+            visdict['albedo'] = additional['albedo']
 
-        if 'predicted_detailed_image' in additional.keys() and additional['predicted_detailed_image'] is not None:
-            visdict['output_images_detail'] = additional['predicted_detailed_image'][visind]
+        if 'predicted_detailed_image' in additional_keys and additional['predicted_detailed_image'] is not None:
+            visdict['output_images_detail'] = additional['predicted_detailed_image']
 
-        if 'predicted_detailed_translated_image' in additional.keys() and additional['predicted_detailed_translated_image'] is not None:
-            visdict['output_translated_images_detail'] = additional['predicted_detailed_translated_image'][visind]
+        if 'predicted_detailed_translated_image' in additional_keys and additional['predicted_detailed_translated_image'] is not None:
+            visdict['output_translated_images_detail'] = additional['predicted_detailed_translated_image']
 
-        if 'shape_detail_images' in additional.keys():
-            visdict['shape_detail_images'] = additional['shape_detail_images'][visind]
+        if 'shape_detail_images' in additional_keys:
+            visdict['shape_detail_images'] = additional['shape_detail_images']
 
-        if 'uv_detail_normals' in additional.keys():
-            visdict['uv_detail_normals'] = additional['uv_detail_normals'][visind] * 0.5 + 0.5
+        if 'uv_detail_normals' in additional_keys:
+            # one new tensor, the shift is done in place
+            visdict['uv_detail_normals'] = additional['uv_detail_normals'].detach().mul(0.5).add_(0.5)
 
-        if 'uv_texture_patch' in additional.keys():
-            visdict['uv_texture_patch'] = additional['uv_texture_patch'][visind]
+        if 'uv_texture_patch' in additional_keys:
+            visdict['uv_texture_patch'] = additional['uv_texture_patch']
 
-        if 'uv_texture_gt' in additional.keys():
-            visdict['uv_texture_gt'] = additional['uv_texture_gt'][visind]
+        if 'uv_texture_gt' in additional_keys:
+            visdict['uv_texture_gt'] = additional['uv_texture_gt']
 
-        if 'translated_uv_texture' in additional.keys() and additional['translated_uv_texture'] is not None:
-            visdict['translated_uv_texture'] = additional['translated_uv_texture'][visind]
+        if 'translated_uv_texture' in additional_keys and additional['translated_uv_texture'] is not None:
+            visdict['translated_uv_texture'] = additional['translated_uv_texture']
 
-        if 'uv_vis_mask_patch' in additional.keys():
-            visdict['uv_vis_mask_patch'] = additional['uv_vis_mask_patch'][visind]
+        if 'uv_vis_mask_patch' in additional_keys:
+            visdict['uv_vis_mask_patch'] = additional['uv_vis_mask_patch']
 
         if save:
             savepath = f'{self.inout_params.full_run_dir}/{prefix}_{stage}/combined/{self.current_epoch:04d}_{batch_idx:04d}.png'
@@ -2380,8 +2779,12 @@ class DECA(torch.nn.Module):
 
     def _reconfigure(self, config):
         self.config = config
+        # see train()
+        self._train_plans = {}
         
         self.n_param = config.n_shape + config.n_tex + config.n_exp + config.n_pose + config.n_cam + config.n_light
+        # sizes of the parts of the coarse code, see decompose_code
+        self._code_split_sizes = [config.n_shape, config.n_tex, config.n_exp, config.n_pose, config.n_cam, config.n_light]
         # identity-based detail code 
         self.n_detail = config.n_detail
         # emotion-based detail code (deprecated, not use by DECA or EMOCA)
@@ -2405,12 +2808,27 @@ class DECA(torch.nn.Module):
         self._create_detail_generator()
         self._init_deep_losses()
         self._setup_neural_rendering()
+        if hasattr(self, 'E_detail'):
+            self._setup_gradient_checkpointing()
 
     def _reinitialize(self):
         self._create_model()
         self._setup_renderer()
         self._init_deep_losses()
         self.face_attr_mask = util.load_local_mask(image_size=self.config.uv_size, mode='bbx')
+        self._setup_gradient_checkpointing()
+
+    def _setup_gradient_checkpointing(self):
+        """
+        Enables gradient checkpointing of the detail encoder backbone if the config asks for it ('gradient_checkpointing').
+        This trades an extra forward pass for a large part of the activation memory (useful with the ring exchange
+        augmentation, which doubles the batch). Only supported for the ResNet backbone.
+        """
+        enabled = 'gradient_checkpointing' in self.config.keys() and bool(self.config.gradient_checkpointing)
+        if isinstance(self.E_detail, ResnetEncoder):
+            self.E_detail.encoder.gradient_checkpointing = enabled
+        elif enabled:
+            print(f"Gradient checkpointing is not supported for {self.E_detail.__class__.__name__}. It will not be used.")
 
     def _init_deep_losses(self):
         """
@@ -2443,9 +2861,19 @@ class DECA(torch.nn.Module):
                 self.vgg_loss = VGG19Loss(dict(zip(self.config.vgg_loss_layers, self.config.lambda_vgg_layers)), batch_norm=vgg_loss_batch_norm).eval()
                 self.vgg_loss.requires_grad_(False) # TODO, move this to the constructor
 
+        if 'channels_last' in self.config.keys() and self.config.channels_last:
+            # the loss networks consume the channels last rendered images, see DecaModule.decode
+            for loss_net in [self.perceptual_loss, self.id_loss, self.vgg_loss]:
+                if loss_net is not None:
+                    loss_net.to(memory_format=torch.channels_last)
+
     def _setup_renderer(self):
         self.render = SRenderY(self.config.image_size, obj_filename=self.config.topology_path,
                                uv_size=self.config.uv_size)  # .to(self.device)
+        # host copy of the mesh topology, see create_mesh
+        self._mesh_topology_np = None
+        # compile the mesh upsampling (numba) in the background, so that the first create_mesh call does not wait for it
+        util.warmup_upsample_mesh_once()
         # face mask for rendering details
         mask = imread(self.config.face_mask_path).astype(np.float32) / 255.
         mask = torch.from_numpy(mask[:, :, 0])[None, None, :, :].contiguous()
@@ -2585,41 +3013,45 @@ class DECA(torch.nn.Module):
         print("Add D_detail.parameters() to the optimizer")
         return trainable_params
 
+    def _train_mode_overrides(self):
+        """
+        The direct submodules that train(True) puts into a different mode than the rest (or whose mode has to be set
+        after the others), in the order in which the modes are set.
+        """
+        if self.mode == DecaMode.COARSE:
+            overrides = {'E_flame': True, 'E_detail': False, 'D_detail': False}
+        elif self.mode == DecaMode.DETAIL:
+            overrides = {'E_flame': bool(self.config.train_coarse), 'E_detail': True, 'D_detail': True}
+        else:
+            raise ValueError(f"Invalid mode '{self.mode}'")
+        # these are set to eval no matter what, they're never being trained (the FLAME shape and texture spaces are pretrained)
+        overrides['flame'] = False
+        overrides['flametex'] = False
+        # the ID-MRF and identity loss networks are kept in eval mode, as DecaModule.train has always done. The VGG loss
+        # follows the mode of DECA (its optional BatchNorm layers train with batch statistics, 'vgg_loss_batch_norm')
+        overrides['perceptual_loss'] = False
+        overrides['id_loss'] = False
+        return overrides
+
     def train(self, mode: bool = True):
-        super().train(mode)
+        # the plan (which submodules are trained) only depends on the mode and the config, so it is computed once
+        plan_key = (self.mode, self.mode == DecaMode.DETAIL and bool(self.config.train_coarse))
         if mode:
-            if self.mode == DecaMode.COARSE:
-                self.E_flame.train()
-                # print("Setting E_flame to train")
-                self.E_detail.eval()
-                # print("Setting E_detail to eval")
-                self.D_detail.eval()
-                # print("Setting D_detail to eval")
-            elif self.mode == DecaMode.DETAIL:
-                if self.config.train_coarse:
-                    # print("Setting E_flame to train")
-                    self.E_flame.train()
-                else:
-                    # print("Setting E_flame to eval")
-                    self.E_flame.eval()
-                self.E_detail.train()
-                # print("Setting E_detail to train")
-                self.D_detail.train()
-                # print("Setting D_detail to train")
-            else:
-                raise ValueError(f"Invalid mode '{self.mode}'")
+            if plan_key not in self._train_plans:
+                self._train_plans[plan_key] = self._train_mode_overrides()
+            overrides = self._train_plans[plan_key]
         else:
-            self.E_flame.eval()
-            # print("Setting E_flame to eval")
-            self.E_detail.eval()
-            # print("Setting E_detail to eval")
-            self.D_detail.eval()
-            # print("Setting D_detail to eval")
-
-        # these are set to eval no matter what, they're never being trained (the FLAME shape and texture spaces are pretrained)
-        self.flame.eval()
-        if self.flametex is not None:
-            self.flametex.eval()
+            overrides = {}
+
+        # each submodule is set (recursively) only once
+        self.training = mode
+        for name, child in self._modules.items():
+            if child is not None and name not in overrides:
+                child.train(mode)
+        for name, child_mode in overrides.items():
+            child = self._modules.get(name, None)
+            if child is not None:
+                child.train(child_mode)
         return self
 
 
@@ -2631,7 +3063,7 @@ class DECA(torch.nn.Module):
         if self.config.resume_training:
             model_path = self.config.pretrained_modelpath
             print(f"Loading model state from '{model_path}'")
-            checkpoint = torch.load(model_path)
+            checkpoint = util.load_model_state_dicts(model_path)
             # model
             util.copy_state_dict(self.E_flame.state_dict(), checkpoint['E_flame'])
             # util.copy_state_dict(self.opt.state_dict(), checkpoint['opt']) # deprecate
@@ -2654,13 +3086,7 @@ class DECA(torch.nn.Module):
         '''
         config.n_shape + config.n_tex + config.n_exp + config.n_pose + config.n_cam + config.n_light
         '''
-        code_list = []
-        num_list = [self.config.n_shape, self.config.n_tex, self.config.n_exp, self.config.n_pose, self.config.n_cam,
-                    self.config.n_light]
-        start = 0
-        for i in range(len(num_list)):
-            code_list.append(code[:, start:start + num_list[i]])
-            start = start + num_list[i]
+        code_list = list(torch.split(code, self._code_split_sizes, dim=1))
         # shapecode, texcode, expcode, posecode, cam, lightcode = code_list
         code_list[-1] = code_list[-1].reshape(code.shape[0], 9, 3)
         return code_list
@@ -2670,19 +3096,16 @@ class DECA(torch.nn.Module):
         Converts the displacement uv map (uv_z) and coarse_verts to a normal map coarse_normals. 
         """
         batch_size = uv_z.shape[0]
-        uv_coarse_vertices = self.render.world2uv(coarse_verts)#.detach()
-        if detach:
-            uv_coarse_vertices = uv_coarse_vertices.detach()
-        uv_coarse_normals = self.render.world2uv(coarse_normals)#.detach()
+        # vertices and normals are projected to the UV space together (one rasterization of 6 channels)
+        uv_coarse_vertices_normals = self.render.world2uv(torch.cat([coarse_verts, coarse_normals], dim=-1))
         if detach:
-            uv_coarse_normals = uv_coarse_normals.detach()
-
-        uv_z = uv_z * self.uv_face_eye_mask
+            uv_coarse_vertices_normals = uv_coarse_vertices_normals.detach()
+        uv_coarse_vertices, uv_coarse_normals = uv_coarse_vertices_normals[:, :3], uv_coarse_vertices_normals[:, 3:]
 
         # detail vertices = coarse vertice + predicted displacement*normals + fixed displacement*normals
-        uv_detail_vertices = uv_coarse_vertices + \
-                             uv_z * uv_coarse_normals + \
-                             self.fixed_uv_dis[None, None, :,:] * uv_coarse_normals #.detach()
+        # (the fixed displacement map [H, W] broadcasts over batch and channels)
+        uv_detail_vertices = _displace_vertices(uv_z, uv_coarse_vertices, uv_coarse_normals, self.uv_face_eye_mask,
+                                                self.fixed_uv_dis)
 
         dense_vertices = uv_detail_vertices.permute(0, 2, 3, 1).reshape([batch_size, -1, 3])
         uv_detail_normals = util.vertex_normals(dense_vertices, self.render.dense_faces.expand(batch_size, -1, -1))
@@ -2699,12 +3122,15 @@ class DECA(torch.nn.Module):
             if visdict[key] is None:
                 continue
             grids[key] = torchvision.utils.make_grid(
-                F.interpolate(visdict[key], [self.config.image_size, self.config.image_size])).detach().cpu()
-        grid = torch.cat(list(grids.values()), catdim)
-        grid_image = (grid.numpy().transpose(1, 2, 0).copy() * 255)[:, :, [2, 1, 0]]
-        grid_image = np.minimum(np.maximum(grid_image, 0), 255).astype(np.uint8)
+                F.interpolate(visdict[key].detach(), [self.config.image_size, self.config.image_size]))
+        # the grids are put together, converted to 8-bit BGR on the device (a GPU one if any), so that a single uint8
+        # image is copied to the host (instead of every float grid)
+        device = next((g.device for g in grids.values() if g.is_cuda), next(iter(grids.values())).device)
+        grid = torch.cat([g.to(device=device, dtype=torch.float32) for g in grids.values()], catdim)
+        grid_image = grid[[2, 1, 0]].mul_(255).clamp_(0, 255).to(torch.uint8).permute(1, 2, 0).contiguous().cpu().numpy()
         if savepath is not None:
-            cv2.imwrite(savepath, grid_image)
+            # written in the background (from a copy of grid_image)
+            _write_async(cv2.imwrite, savepath, grid_image)
         return grid_image
 
     def create_mesh(self, opdict, dense_template):
@@ -2713,21 +3139,34 @@ class DECA(torch.nn.Module):
         texture: [3, h, w], tensor
         '''
         i = 0
-        vertices = opdict['verts'][i].cpu().numpy()
-        faces = self.render.faces[0].cpu().numpy()
-        if 'uv_texture_gt' in opdict.keys():
-            texture = util.tensor2image(opdict['uv_texture_gt'][i])
+        # the mesh topology does not change, it is copied to the host only once
+        if getattr(self, '_mesh_topology_np', None) is None:
+            self._mesh_topology_np = (self.render.faces[0].cpu().numpy(), self.render.raw_uvcoords[0].cpu().numpy(),
+                                      self.render.uvfaces[0].cpu().numpy())
+        faces, uvcoords, uvfaces = self._mesh_topology_np
+
+        # the per-sample tensors are copied to the host together
+        has_texture = 'uv_texture_gt' in opdict.keys()
+        has_detail = 'uv_detail_normals' in opdict.keys()
+        tensors = [opdict['verts'][i]]
+        if has_texture:
+            tensors += [opdict['uv_texture_gt'][i]]
+        if has_detail:
+            tensors += [opdict['uv_detail_normals'][i]*0.5 + 0.5, opdict['normals'][i], opdict['displacement_map'][i]]
+        host_tensors = _tensors_to_host(tensors)
+
+        vertices = host_tensors.pop(0).numpy()
+        if has_texture:
+            texture = util.tensor2image(host_tensors.pop(0))
         else:
             texture = None
-        uvcoords = self.render.raw_uvcoords[0].cpu().numpy()
-        uvfaces = self.render.uvfaces[0].cpu().numpy()
         # save coarse mesh, with texture and normal map
-        if 'uv_detail_normals' in opdict.keys():
-            normal_map = util.tensor2image(opdict['uv_detail_normals'][i]*0.5 + 0.5)
+        if has_detail:
+            normal_map = util.tensor2image(host_tensors.pop(0))
             # upsample mesh, save detailed mesh
             texture = texture[:, :, [2, 1, 0]]
-            normals = opdict['normals'][i].cpu().numpy()
-            displacement_map = opdict['displacement_map'][i].detach().cpu().numpy().squeeze()
+            normals = host_tensors.pop(0).numpy()
+            displacement_map = host_tensors.pop(0).numpy().squeeze()
             dense_vertices, dense_colors, dense_faces = util.upsample_mesh(vertices, normals, faces,
                                                                            displacement_map, texture, dense_template)
         else:
@@ -2739,7 +3178,11 @@ class DECA(torch.nn.Module):
         return vertices, faces, texture, uvcoords, uvfaces, normal_map, dense_vertices, dense_faces, dense_colors
 
 
-    def save_obj(self, filename, opdict, dense_template, mode ='detail'):
+    def save_obj(self, filename, opdict, dense_template, mode ='detail', asynchronous=False):
+        """
+        Saves the coarse and/or detailed mesh. If asynchronous, the files are written by a background thread (see
+        flush_async_writes), otherwise they are on disk when the function returns.
+        """
         if mode not in ['coarse', 'detail', 'both']:
             raise ValueError(f"Invalid mode '{mode}. Expected modes are: 'coarse', 'detail', 'both'")
 
@@ -2758,19 +3201,20 @@ class DECA(torch.nn.Module):
         else:
             filename_detail = filename
 
+        write = _write_async if asynchronous else _write_now
         if mode in ['coarse', 'both']:
-            util.write_obj(str(filename_coarse), vertices, faces,
-                            texture=texture,
-                            uvcoords=uvcoords,
-                            uvfaces=uvfaces,
-                            normal_map=normal_map)
+            write(util.write_obj, str(filename_coarse), vertices, faces,
+                  texture=texture,
+                  uvcoords=uvcoords,
+                  uvfaces=uvfaces,
+                  normal_map=normal_map)
 
         if mode in ['detail', 'both']:
-            util.write_obj(str(filename_detail),
-                            dense_vertices,
-                            dense_faces,
-                            colors = dense_colors,
-                            inverse_face_order=True)
+            write(util.write_obj, str(filename_detail),
+                  dense_vertices,
+                  dense_faces,
+                  colors = dense_colors,
+                  inverse_face_order=True)
 
 
 from gdl.models.EmoNetRegressor import EmoNetRegressor, EmonetRegressorStatic
@@ -2787,6 +3231,8 @@ class ExpDECA(DECA):
         super()._create_model()
         # E_flame should be fixed for expression EMOCA
         self.E_flame.requires_grad_(False)
+        # TorchScript trace of the fixed E_flame (created on first use), see _encode_fixed_flame
+        self.__dict__['_E_flame_traced'] = None
         
         # 2) add expression decoder
         if self.config.expression_backbone == 'deca_parallel':
@@ -2794,6 +3240,8 @@ class ExpDECA(DECA):
             self.E_expression = SecondHeadResnet(self.E_flame, self.n_exp_param, 'same')
         elif self.config.expression_backbone == 'deca_clone':
             ## b) Clones the original DECA coarse decoder (and the entire decoder will be trainable) - This is in final EMOCA.
+            # The backbone cannot be shared with E_flame here (its weights diverge from E_flame's during training), so
+            # two backbone passes are needed. For a single shared backbone pass use 'deca_parallel'.
             #TODO this will only work for Resnet. Make this work for the other backbones (Swin) as well.
             self.E_expression = ResnetEncoder(self.n_exp_param)
             # clone parameters of the ResNet
@@ -2825,10 +3273,37 @@ class ExpDECA(DECA):
             #SecondHeadResnet does the forward pass for shape and expression at the same time
             return self.E_expression(images)
         # other regressors have to do a separate pass over the image
-        deca_code = super()._encode_flame(images)
+        deca_code = self._encode_fixed_flame(images)
         exp_deca_code = self.E_expression(images)
         return deca_code, exp_deca_code
 
+    def _encode_fixed_flame(self, images):
+        """
+        Forward pass of the fixed E_flame. With the 'trace_fixed_encoder' config, E_flame is traced with TorchScript on
+        first use. It is always in eval mode and without gradient, so the trace is valid for all later calls. The trace
+        is made and used in full precision only (under autocast, the eager E_flame is used), it is dropped whenever the
+        module is moved or cast (see _apply) and is not pickled (see __getstate__).
+        """
+        if not ('trace_fixed_encoder' in self.config.keys() and self.config.trace_fixed_encoder) \
+                or torch.is_autocast_enabled():
+            return self.E_flame(images)
+        if self._E_flame_traced is None:
+            with torch.no_grad():
+                # kept out of the submodules (the state dict stays the same), the trace shares the parameters of E_flame
+                self.__dict__['_E_flame_traced'] = torch.jit.trace(self.E_flame, images, check_trace=False)
+        return self._E_flame_traced(images)
+
+    def _apply(self, fn):
+        # the trace holds the parameter tensors it was created with, it is recreated after moving/casting the module
+        self.__dict__['_E_flame_traced'] = None
+        return super()._apply(fn)
+
+    def __getstate__(self):
+        # the trace cannot be pickled (deepcopy, DDP spawn), it is recreated on first use
+        state = self.__dict__.copy()
+        state['_E_flame_traced'] = None
+        return state
+
     def decompose_code(self, code):
         deca_code = code[0]
         expdeca_code = code[1]
@@ -2864,37 +3339,13 @@ class ExpDECA(DECA):
 
         return deca_code_list
 
-    def train(self, mode: bool = True):
-        super().train(mode)
-
+    def _train_mode_overrides(self):
+        overrides = super()._train_mode_overrides()
         # for expression deca, we are not training the resnet feature extractor plus the identity/light/texture regressor
-        self.E_flame.eval()
-
-        if mode:
-            if self.mode == DecaMode.COARSE:
-                self.E_expression.train()
-                # print("Setting E_expression to train")
-                self.E_detail.eval()
-                # print("Setting E_detail to eval")
-                self.D_detail.eval()
-                # print("Setting D_detail to eval")
-            elif self.mode == DecaMode.DETAIL:
-                if self.config.train_coarse:
-                    # print("Setting E_flame to train")
-                    self.E_expression.train()
-                else:
-                    # print("Setting E_flame to eval")
-                    self.E_expression.eval()
-                self.E_detail.train()
-                # print("Setting E_detail to train")
-                self.D_detail.train()
-            else:
-                raise ValueError(f"Invalid mode '{self.mode}'")
-        else:
-            self.E_expression.eval()
-            self.E_detail.eval()
-            self.D_detail.eval()
-        return self
+        overrides['E_flame'] = False
+        # set after E_flame (E_expression may share E_flame's backbone, 'deca_parallel')
+        overrides['E_expression'] = self.mode == DecaMode.COARSE or bool(self.config.train_coarse)
+        return overrides
 
 
 def instantiate_deca(cfg, stage, prefix, checkpoint=None, checkpoint_kwargs=None):
@@ -348,9 +348,12 @@ class SRenderY(nn.Module):
         shading = normals_dot_lights[:, :, :, None] * light_intensities[:, :, None, :]
         return shading.mean(1)
 
-    def render_shape(self, vertices, transformed_vertices, images=None, detail_normal_images=None, lights=None):
+    def render_shape(self, vertices, transformed_vertices, images=None, detail_normal_images=None, lights=None,
+                     return_coarse=False):
         '''
         -- rendering shape with detail normal map
+        -- with return_coarse, the shape shaded with the coarse normals is returned as well (both are shaded from the
+           same rasterization): (coarse shape images, detail shape images)
         '''
         batch_size = vertices.shape[0]
         if lights is None:
@@ -394,10 +397,19 @@ class SRenderY(nn.Module):
         normal_images = rendering[:, 9:12, :, :].detach()
         vertice_images = rendering[:, 6:9, :, :].detach()
         if detail_normal_images is not None:
-            normal_images = detail_normal_images
+            if return_coarse:
+                # coarse and detail normals are shaded in one batch
+                normal_images = torch.cat([normal_images, detail_normal_images], dim=0)
+                albedo_images = albedo_images.repeat(2, 1, 1, 1)
+                alpha_images = alpha_images.repeat(2, 1, 1, 1)
+                lights = lights.repeat(2, 1, 1)
+                if images is not None:
+                    images = images.repeat(2, 1, 1, 1)
+            else:
+                normal_images = detail_normal_images
 
-        shading = self.add_directionlight(normal_images.permute(0, 2, 3, 1).reshape([batch_size, -1, 3]), lights)
-        shading_images = shading.reshape([batch_size, albedo_images.shape[2], albedo_images.shape[3], 3]).permute(0, 3,
+        shading = self.add_directionlight(normal_images.permute(0, 2, 3, 1).reshape([normal_images.shape[0], -1, 3]), lights)
+        shading_images = shading.reshape([normal_images.shape[0], albedo_images.shape[2], albedo_images.shape[3], 3]).permute(0, 3,
                                                                                                                   1,
                                                                                                                   2).contiguous()
         shaded_images = albedo_images * shading_images
@@ -407,6 +419,10 @@ class SRenderY(nn.Module):
                         1 - alpha_images)
         else:
             shape_images = shaded_images * alpha_images + images * (1 - alpha_images)
+        if return_coarse:
+            if detail_normal_images is None:
+                return shape_images, None
+            return shape_images.chunk(2)
         return shape_images
 
     def render_depth(self, transformed_vertices):
@@ -448,11 +464,11 @@ class SRenderY(nn.Module):
     def world2uv(self, vertices):
         '''
         project vertices from world space to uv space
-        vertices: [bz, V, 3]
-        uv_vertices: [bz, 3, h, w]
+        vertices: [bz, V, C] (usually C = 3, but any per-vertex attributes can be projected at once)
+        uv_vertices: [bz, C, h, w]
         '''
         batch_size = vertices.shape[0]
         face_vertices = util.face_vertices(vertices, self.faces.expand(batch_size, -1, -1))
         uv_vertices = self.uv_rasterizer(self.uvcoords.expand(batch_size, -1, -1),
-                                         self.uvfaces.expand(batch_size, -1, -1), face_vertices)[:, :3]
+                                         self.uvfaces.expand(batch_size, -1, -1), face_vertices)[:, :vertices.shape[-1]]
         return uv_vertices
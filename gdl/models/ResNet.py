@@ -21,6 +21,29 @@ import torch.optim as optim
 import numpy as np
 import math
 import torchvision
+from torch.utils.checkpoint import checkpoint
+
+
+def _checkpointed_stage(stage, x):
+    """
+    Runs a residual stage inside torch.utils.checkpoint. The first pass runs without grad, the recomputation in the
+    backward pass with grad. The recomputation sees the same batch (same batch statistics), but it would update the
+    running statistics of the BatchNorm layers a second time, so they are restored afterwards.
+    """
+    if not torch.is_grad_enabled():
+        return stage(x)
+    batch_norms = [m for m in stage.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+                   and m.training and m.track_running_stats]
+    running_stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone())
+                     for m in batch_norms]
+    out = stage(x)
+    with torch.no_grad():
+        for m, (mean, var, num_batches) in zip(batch_norms, running_stats):
+            m.running_mean.copy_(mean)
+            m.running_var.copy_(var)
+            m.num_batches_tracked.copy_(num_batches)
+    return out
+
 
 class ResNet(nn.Module):
     def __init__(self, block, layers, num_classes=1000):
@@ -37,6 +60,8 @@ class ResNet(nn.Module):
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
         self.avgpool = nn.AvgPool2d(7, stride=1)
        # self.fc = nn.Linear(512 * block.expansion, num_classes)
+        # if enabled, the activations of the residual stages are recomputed in the backward pass instead of being stored
+        self.gradient_checkpointing = False
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -69,10 +94,16 @@ class ResNet(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x1 = self.layer4(x)
+        if self.gradient_checkpointing and self.training and x.requires_grad:
+            x = checkpoint(_checkpointed_stage, self.layer1, x)
+            x = checkpoint(_checkpointed_stage, self.layer2, x)
+            x = checkpoint(_checkpointed_stage, self.layer3, x)
+            x1 = checkpoint(_checkpointed_stage, self.layer4, x)
+        else:
+            x = self.layer1(x)
+            x = self.layer2(x)
+            x = self.layer3(x)
+            x1 = self.layer4(x)
 
         x2 = self.avgpool(x1)
         x2 = x2.view(x2.size(0), -1)
@@ -4,12 +4,90 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import math
+import inspect
+import pickle
 from collections import OrderedDict
 import os
-from scipy.ndimage import morphology
+import threading
 from skimage.io import imsave
 import cv2
 
+try:
+    from numba import njit, prange
+except ImportError as e:
+    # numba is optional, without it mesh upsampling uses the (slower) numpy implementation
+    njit = None
+
+
+# the compiled kernel is cached on disk (cache=True), next to this file or, if that is not writable, in the user-wide
+# cache directory. Set NUMBA_CACHE_DIR to a persistent location for read-only installs (e.g. docker images).
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _upsample_mesh_kernel(vertices, normals, displacement_map, texture_map, pixel_3d_faces, pixel_b_coords,
+                              pixel_y, pixel_x):
+        """
+        Per dense vertex: barycentric interpolation of the coarse vertex and normal, displaced along the normalized
+        normal by the displacement map, and the color looked up from the texture map (same as the numpy path of
+        upsample_mesh, without the intermediate arrays).
+        """
+        n = pixel_3d_faces.shape[0]
+        dense_vertices = np.empty((n, 3))
+        dense_colors = np.empty((n, texture_map.shape[2]), dtype=texture_map.dtype)
+        for k in prange(n):
+            point = np.zeros(3)
+            normal = np.zeros(3)
+            for j in range(3):
+                face_vertex = pixel_3d_faces[k, j]
+                b = pixel_b_coords[k, j]
+                for c in range(3):
+                    point[c] += vertices[face_vertex, c] * b
+                    normal[c] += normals[face_vertex, c] * b
+            norm = np.sqrt(normal[0] * normal[0] + normal[1] * normal[1] + normal[2] * normal[2])
+            displacement = displacement_map[pixel_y[k], pixel_x[k]]
+            for c in range(3):
+                dense_vertices[k, c] = point[c] + displacement * (normal[c] / norm)
+            for c in range(texture_map.shape[2]):
+                dense_colors[k, c] = texture_map[pixel_y[k], pixel_x[k], c]
+        return dense_vertices, dense_colors
+else:
+    _upsample_mesh_kernel = None
+
+# numba's default (workqueue) threading layer does not support parallel kernels launched from several threads at once
+_upsample_mesh_lock = threading.Lock()
+
+
+def warmup_upsample_mesh():
+    """
+    Calls the numba kernel of upsample_mesh once on a dummy mesh (with the argument types of the real calls), so that
+    it is compiled (or loaded from the cache) before the first mesh is saved. Does nothing without numba.
+    """
+    if _upsample_mesh_kernel is None:
+        return
+    vertices = np.zeros((4, 3), dtype=np.float32)
+    normals = np.ones((4, 3), dtype=np.float32)
+    displacement_map = np.zeros((2, 2), dtype=np.float32)
+    texture_map = np.zeros((2, 2, 3), dtype=np.uint8)
+    pixel_3d_faces = np.array([[0, 1, 2], [1, 2, 3]], dtype=np.int64)
+    pixel_b_coords = np.full((2, 3), 1. / 3.)
+    pixel_coords = np.zeros(2, dtype=np.int64)
+    with _upsample_mesh_lock:
+        _upsample_mesh_kernel(vertices, normals, displacement_map, texture_map, pixel_3d_faces, pixel_b_coords,
+                              pixel_coords, pixel_coords)
+
+
+_upsample_mesh_warmup_started = False
+
+
+def warmup_upsample_mesh_once():
+    """
+    Starts warmup_upsample_mesh in a background thread, only the first time it is called in the process.
+    """
+    global _upsample_mesh_warmup_started
+    if _upsample_mesh_kernel is None or _upsample_mesh_warmup_started:
+        return
+    _upsample_mesh_warmup_started = True
+    threading.Thread(target=warmup_upsample_mesh, daemon=True).start()
+
 
 def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense_template):
     ''' upsampling coarse mesh (with displacment map)
@@ -32,6 +110,15 @@ def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense
     valid_pixel_3d_faces = dense_template['valid_pixel_3d_faces']
     valid_pixel_b_coords = dense_template['valid_pixel_b_coords']
 
+    if _upsample_mesh_kernel is not None:
+        with _upsample_mesh_lock:
+            dense_vertices, dense_colors = _upsample_mesh_kernel(
+                np.ascontiguousarray(vertices), np.ascontiguousarray(normals), np.ascontiguousarray(displacement_map),
+                np.ascontiguousarray(texture_map), valid_pixel_3d_faces.astype(np.int64),
+                valid_pixel_b_coords.astype(np.float64), y_coords[valid_pixel_ids].astype(np.int64),
+                x_coords[valid_pixel_ids].astype(np.int64))
+        return dense_vertices, dense_colors, dense_faces
+
     pixel_3d_points = vertices[valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
                     vertices[valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
                     vertices[valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
@@ -338,16 +425,22 @@ def deg2rad(tensor):
     return tensor * torch.tensor(math.pi).to(tensor.device).type(tensor.dtype) / 180.
 
 
-def batch_orth_proj(X, camera):
+@torch.jit.script
+def batch_orth_proj(X: torch.Tensor, camera: torch.Tensor, flip_yz: bool = False) -> torch.Tensor:
     '''
         X is N x num_pquaternion_to_angle_axisoints x 3
+        flip_yz: if True, the y and z axes of the projection are negated (camera to image space), 
+        which is folded into the scaling so that no extra pass over the points is needed
     '''
     camera = camera.clone().view(-1, 1, 3)
     X_trans = X[:, :, :2] + camera[:, :, 1:]
     X_trans = torch.cat([X_trans, X[:, :, 2:]], 2)
     # shape = X_trans.shape
     # Xn = (camera[:, :, 0] * X_trans.view(shape[0], -1)).view(shape)
-    Xn = (camera[:, :, 0:1] * X_trans)
+    scale = camera[:, :, 0:1]
+    if flip_yz:
+        scale = torch.cat([scale, -scale, -scale], dim=2)
+    Xn = (scale * X_trans)
     return Xn
 
 
@@ -546,13 +639,14 @@ def angle2matrix(angles):
 
 def binary_erosion(tensor, kernel_size=5):
     # tensor: [bz, 1, h, w].
-    device = tensor.device
-    mask = tensor.cpu().numpy()
-    structure = np.ones((kernel_size, kernel_size))
-    new_mask = mask.copy()
-    for i in range(mask.shape[0]):
-        new_mask[i, 0] = morphology.binary_erosion(mask[i, 0], structure)
-    return torch.from_numpy(new_mask.astype(np.float32)).to(device)
+    # Erosion of the (nonzero) mask with a square structuring element, computed on the tensor's device as a dilation
+    # (max pooling) of the background. Equivalent to scipy's morphology.binary_erosion with border_value=0, i.e.
+    # everything outside of the image counts as background.
+    background = (tensor == 0).float()
+    pad_before = kernel_size // 2
+    pad_after = kernel_size - 1 - pad_before
+    background = F.pad(background, [pad_before, pad_after, pad_before, pad_after], value=1.)
+    return 1. - F.max_pool2d(background, kernel_size, stride=1)
 
 
 def flip_image(src_image, kps):
@@ -597,6 +691,50 @@ def copy_state_dict(cur_state_dict, pre_state_dict, prefix='', load_name=None):
             continue
 
 
+# torch.load got the 'mmap' argument only in torch 2.1
+_TORCH_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+
+def load_model_state_dicts(model_path):
+    """
+    Loads a checkpoint of the original DECA implementation (a dict of state dicts such as 'E_flame', 'E_detail',
+    'D_detail'). Checkpoints converted with save_model_state_dicts_safetensors are memory mapped by safetensors
+    (no unpickling), the original ones are loaded with torch.load onto the CPU (memory mapped if torch supports it).
+    """
+    if str(model_path).endswith('.safetensors'):
+        from safetensors.torch import load_file
+        flat_state_dict = load_file(str(model_path), device='cpu')
+        checkpoint = {}
+        for key, value in flat_state_dict.items():
+            name, param_key = key.split('.', 1)
+            checkpoint.setdefault(name, OrderedDict())[param_key] = value
+        return checkpoint
+    if _TORCH_LOAD_MMAP:
+        # newer versions of torch can memory map the storages (and load only tensors, no arbitrary pickled objects)
+        try:
+            return torch.load(model_path, map_location='cpu', mmap=True, weights_only=True)
+        except (RuntimeError, pickle.UnpicklingError) as e:
+            # memory mapping is only possible for checkpoints saved in the zipfile format (torch>=1.6) and
+            # weights_only fails if the checkpoint contains other objects than tensors and containers
+            print(f"Could not memory map '{model_path}' ({e}), loading it into memory instead")
+    return torch.load(model_path, map_location='cpu')
+
+
+def save_model_state_dicts_safetensors(model_path, output_path, names=('E_flame', 'E_detail', 'D_detail')):
+    """
+    Converts the state dicts of a checkpoint of the original DECA implementation to a single safetensors file
+    (keys prefixed with the name of the state dict), which can then be loaded with load_model_state_dicts.
+    """
+    from safetensors.torch import save_file
+    checkpoint = torch.load(model_path, map_location='cpu')
+    flat_state_dict = {}
+    for name in names:
+        if name in checkpoint.keys():
+            for key, value in checkpoint[name].items():
+                flat_state_dict[name + '.' + key] = value.contiguous()
+    save_file(flat_state_dict, str(output_path))
+
+
 def check_mkdir(path):
     if not os.path.exists(path):
         print('creating %s' % path)
@@ -1232,6 +1232,7 @@ def single_optimization(path_to_models, relative_to_path, replace_root_path, out
     deca, dm = load_deca_and_data(path_to_models, model_folder, stage, relative_to_path, replace_root_path)
     deca.deca.config.train_coarse = True
     deca.deca.config.mode = DecaMode.DETAIL
+    deca._init_flame_encoding()
     deca.eval()
     # deca.deca.config.mode = DecaMode.COARSE
     # image_index = 390 * 4 + 1
@@ -1297,6 +1298,8 @@ def single_optimization_v2(path_to_models, relative_to_path, replace_root_path,
     deca.deca.config.train_coarse = True
     deca.deca.config.mode = DecaMode.DETAIL
     deca.deca.config.background_from_input = False
+    deca._init_masking_config()
+    deca._init_flame_encoding()
 
     if model_name == "Original_DECA":
         # remember, this is the hacky way to load old Yao's model
@@ -333,6 +333,18 @@ def single_stage_deca_pass(deca, cfg, stage, prefix, dm=None, logger=None,
 
     print(f"After training checkpoint strategy: {cfg.learning.checkpoint_after_training}")
 
+    # 16 enables mixed precision training (autocast of the conv-heavy encoders and losses), 32 is full precision
+    precision = 32
+    if 'precision' in cfg.learning.keys():
+        precision = cfg.learning.precision
+    print(f"Setting precision to {precision}")
+
+    # gradients can be accumulated over several batches, Lightning then skips the DDP gradient all-reduce
+    # (no_sync) on all but the last of the accumulated steps
+    accumulate_grad_batches = 1
+    if 'accumulate_grad_batches' in cfg.learning.keys():
+        accumulate_grad_batches = cfg.learning.accumulate_grad_batches
+
     trainer = Trainer(gpus=cfg.learning.num_gpus,
                       max_epochs=cfg.model.max_epochs,
                       max_steps=max_steps,
@@ -341,6 +353,8 @@ def single_stage_deca_pass(deca, cfg, stage, prefix, dm=None, logger=None,
                       accelerator=accelerator,
                       callbacks=callbacks,
                       val_check_interval=val_check_interval,
+                      precision=precision,
+                      accumulate_grad_batches=accumulate_grad_batches,
                       # num_sanity_val_steps=0
                       )
 
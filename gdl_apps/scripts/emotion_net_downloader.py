@@ -20,13 +20,53 @@ All rights reserved.
 
 import pandas
 import pandas as pd
+import numpy as np
 from pathlib import Path
 from tqdm import auto
-import urllib.request
+import os
+import shutil
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError as e:
+    print("pyarrow not found, the file lists will be parsed with pandas")
+    pacsv = None
+
+if pacsv is not None:
+    has_parquet_engine = True
+else:
+    try:
+        import fastparquet
+        has_parquet_engine = True
+    except ImportError as e:
+        print("Neither pyarrow nor fastparquet found, the full table will be stored as csv")
+        has_parquet_engine = False
 
 path_to_files = "/ps/project_cifs/EmotionalFacialAnimation/data/emotionnet/emotioNet_challenge_files_server_challenge_1.2_aws"
 output_path = "/ps/project_cifs/EmotionalFacialAnimation/data/emotionnet/emotioNet_challenge_files_server_challenge_1.2_aws_downloaded"
-path_to_full_table = Path(path_to_files) / "full_table.csv"
+path_to_full_table = Path(path_to_files) / "full_table.parquet"
+# the full table used to be stored as csv, it gets converted to parquet on first use (if a parquet engine is installed)
+path_to_full_table_csv = Path(path_to_files) / "full_table.csv"
+
+columns = ["url", "orig_url", ]
+columns += [f"AU{i}" for i in range(1,61)]
+# the AU labels are small integers (999 marks a missing label), int16 takes a quarter of the memory of int64
+au_dtypes = {f"AU{i}": "int16" for i in range(1,61)}
+
+
+def _read_file_list(path):
+    if pacsv is not None:
+        # pyarrow parses the file with multiple threads (pandas uses one)
+        table = pacsv.read_csv(path,
+                               read_options=pacsv.ReadOptions(column_names=columns),
+                               parse_options=pacsv.ParseOptions(delimiter="\t"),
+                               convert_options=pacsv.ConvertOptions(
+                                   column_types={name: pa.int16() for name in au_dtypes.keys()}))
+        return table.to_pandas()
+    return pd.read_csv(path, delimiter="\t", names=columns, dtype=au_dtypes, engine="c", low_memory=False)
+
 
 def read_original_file_list(index):
     image_lists = sorted(list(Path(path_to_files).glob("*.txt")))
@@ -35,82 +75,126 @@ def read_original_file_list(index):
     Path(output_path).mkdir(parents=True, exist_ok=True)
     data_frames = []
 
-    columns = ["url", "orig_url", ]
-    columns += [f"AU{i}" for i in range(1,61)]
-
-    df = pd.read_csv(image_lists[index], delimiter="\t", names = columns)
+    df = _read_file_list(image_lists[index])
     data_frames += [df]
 
     return df
 
 
+def save_full_table(full_df):
+    if has_parquet_engine:
+        full_df.to_parquet(path_to_full_table, compression="zstd", index=False)
+    else:
+        full_df.to_csv(path_to_full_table_csv, index=False)
+
+
 def process_original_file_lists():
     image_lists = sorted(list(Path(path_to_files).glob("*.txt")))
     Path(output_path).mkdir(parents=True, exist_ok=True)
-    data_frames = []
-
-    columns = ["url", "orig_url", ]
-    columns += [f"AU{i}" for i in range(1,61)]
-
-    for l in image_lists:
-        df = pd.read_csv(l, delimiter="\t", names = columns)
-        data_frames += [df]
+    # the parsing releases the GIL, so the lists are read in parallel threads
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        data_frames = list(executor.map(_read_file_list, image_lists))
 
     full_df = pandas.concat(data_frames)
-    full_df.to_csv(path_to_full_table, index=False)
+    save_full_table(full_df)
 
     return full_df
 
 
-def download_images(df=None, index=None):
-    N = len(df)
+def _download(http, url, abs_dl_path):
+    """
+    Streams the response of url to abs_dl_path using the (connection pooling) http pool manager.
+    """
+    response = http.request("GET", url, preload_content=False)
+    try:
+        if response.status != 200:
+            raise RuntimeError(f"Request to '{url}' failed with status {response.status}")
+        with open(abs_dl_path, "wb") as f:
+            # large chunks, fewer write calls
+            shutil.copyfileobj(response, f, length=1 << 20)
+    except Exception:
+        # do not leave a partial file behind (it would be taken for a finished download)
+        if abs_dl_path.exists():
+            abs_dl_path.unlink()
+        raise
+    finally:
+        response.release_conn()
 
-    local_full_df = df.copy(deep=True)
-    local_full_df = local_full_df.assign(path=pd.Series(dtype=str))
-    my_column = local_full_df.pop('path')
-    local_full_df.insert(0, my_column.name, my_column)
-    local_full_df['path'] = local_full_df['path'].astype(str)
-    local_full_df.drop("url",1, inplace=True)
-    local_full_df.drop("orig_url", 1, inplace=True)
 
-    indices_to_remove = []
+def _fetch(http, url, old_url, abs_dl_path):
+    """
+    Downloads the image from url (or old_url if that fails) to abs_dl_path. Returns whether the image is there.
+    """
+    abs_dl_path.parent.mkdir(exist_ok=True, parents=True)
+    try:
+        _download(http, url, abs_dl_path)
+        return True
+    except Exception:
+        try:
+            _download(http, old_url, abs_dl_path)
+            return True
+        except Exception:
+            return False
 
-    for i in auto.tqdm(range(N)):
-        # row = full_df.iloc[[i]]
-        url = df.iloc[i]["url"]
-        old_url = df.iloc[i]["orig_url"]
 
-        rel_path = Path(url).relative_to(Path(url).parents[1])
-        dl_path =  Path("images") / rel_path
+def _relative_path(url):
+    return Path(url).relative_to(Path(url).parents[1])
 
-        abs_dl_path = Path(output_path) / dl_path
-        abs_dl_path.parent.mkdir(exist_ok=True, parents=True)
 
-        success = False
-        if abs_dl_path.exists():
+def download_images(df=None, index=None, num_workers=64):
+    N = len(df)
+
+    # the columns are pulled out once (indexing the data frame row by row is slow)
+    urls = df["url"].to_numpy()
+    old_urls = df["orig_url"].to_numpy()
+    paths = np.empty(N, dtype=object)
+
+    # the already downloaded images are listed with a single walk (instead of a stat call for every image, which is
+    # slow on a shared file system)
+    existing = set()
+    for root, _, files in os.walk(Path(output_path) / "images"):
+        existing.update(os.path.join(root, f) for f in files)
+
+    # the images to download are collected first (their paths are recomputed when needed, not kept for every row)
+    pending = []
+    for i in range(N):
+        rel_path = _relative_path(urls[i])
+        if str(Path(output_path) / "images" / rel_path) in existing:
             # print(f"File already exists. Skipping ... {abs_dl_path}")
-            success = True
+            paths[i] = str(rel_path)
         else:
-            try:
-                urllib.request.urlretrieve(url, abs_dl_path)
-                success = True
-            except Exception:
-                try:
-                    urllib.request.urlretrieve(old_url, abs_dl_path)
-                    success = True
-                except Exception:
-                    success = False
-
-        if not success:
-            print(f"Could not download file from '{url}' or '{old_url}")
-            indices_to_remove += [i]
-            continue
-
-        local_full_df["path"][i] = str(rel_path)
-        # print(local_full_df.iloc[i]["path"])
-
-    if len(indices_to_remove) > 0:
-        local_full_df.drop(index=indices_to_remove, inplace=True)
+            pending.append(i)
+    print(f"{N - len(pending)} images were already downloaded")
+
+    # the downloads are I/O bound, so they run in a thread pool. The workers share a pool manager, so that the
+    # connections to the same host are kept alive and reused (instead of a new connection for every image).
+    # Only a few times num_workers downloads are submitted at once (not a future for every image of the table)
+    http = urllib3.PoolManager(num_pools=16, maxsize=num_workers, retries=urllib3.Retry(total=2))
+    max_in_flight = 4 * num_workers
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, auto.tqdm(total=len(pending)) as progress:
+        in_flight = {}
+        next_pending = 0
+        while next_pending < len(pending) or len(in_flight) > 0:
+            while next_pending < len(pending) and len(in_flight) < max_in_flight:
+                i = pending[next_pending]
+                next_pending += 1
+                abs_dl_path = Path(output_path) / "images" / _relative_path(urls[i])
+                in_flight[executor.submit(_fetch, http, urls[i], old_urls[i], abs_dl_path)] = i
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = in_flight.pop(future)
+                progress.update()
+                if not future.result():
+                    print(f"Could not download file from '{urls[i]}' or '{old_urls[i]}")
+                    continue
+                paths[i] = str(_relative_path(urls[i]))
+
+    # the result table is built from the AU columns and the paths (the url columns are dropped, no deep copy of the
+    # input table is made), the images that could not be downloaded are left out
+    local_full_df = df.drop(columns=["url", "orig_url"])
+    local_full_df.insert(0, "path", paths)
+    local_full_df = local_full_df[pd.notna(paths)]
 
     print("Downloading images completed. Saving the data frame")
     if index is None:
@@ -130,8 +214,12 @@ if __name__ == '__main__':
     else:
         index = None
 
-        if not Path(path_to_full_table).exists():
-            full_df = process_original_file_lists()
+        if has_parquet_engine and Path(path_to_full_table).exists():
+            full_df = pd.read_parquet(path_to_full_table)
+        elif Path(path_to_full_table_csv).exists():
+            full_df = pd.read_csv(path_to_full_table_csv, dtype=au_dtypes)
+            if has_parquet_engine:
+                save_full_table(full_df)
         else:
-            full_df = pd.read_csv(path_to_full_table)
+            full_df = process_original_file_lists()
         download_images(full_df)